@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+'''
+batch.py
+
+Runs large extraction jobs across several machines that share a filesystem, with no coordinating service.
+
+A manifest lists the filing sources, one per line (a path, a zip/report package, or a URL). It can also be
+a CSV file with a "source" column (in any position). Blank lines and lines starting with # are ignored.
+
+Each worker takes a deterministic shard of the manifest and writes partial outputs to a shared directory:
+
+    python batch.py run manifest.txt --shard 1/4 --out results
+    python batch.py run manifest.txt --shard 2/4 --out results
+    ...
+
+Shard i of n gets the manifest entries at positions i-1, i-1+n, i-1+2n, ... so every node gets a similar
+mix of entries whatever order the manifest is in.
+
+By default, local files are first triaged without parsing or decompressing them (see sniff.estimate), once
+each while planning. The shards are then balanced by size instead: largest first, each entry goes to the shard
+with the least bytes so far, and each shard processes its entries largest first, so no node is left with a
+big filing at the end. An entry's size is that of its documents decompressed (added up over a zip's
+documents), which is what parsing takes time on, taken from the zip directory or the gzip trailer. Every node
+sniffs the whole manifest, which only reads the start of each document, and works out the same assignment.
+Files that aren't inline XBRL count as empty and are skipped (with status "skipped" in the timing output).
+URLs can't be sniffed, they are assigned after the files and always processed. --no-sniff turns this off.
+
+Each shard writes:
+
+    summary.shard-i-of-n.csv    one row per document with the config.csv output fields and metrics.csv metrics
+    facts.shard-i-of-n.csv      the fact table (see facts.py) for each document
+    timing.shard-i-of-n.csv     load and extraction seconds, and status or error, for each document
+
+Once every shard is done, merge combines them in manifest order, giving the same summary.csv, facts.csv and
+timing.csv a single-node run (--shard 1/1) would:
+
+    python batch.py merge results
+'''
+
+import argparse
+import csv
+import gc
+import os
+import re
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from facts import columns as fact_columns, fact_rows
+from getix import SummarySpreadsheet, warn_conflicts
+from ixbrl import XbrliDocument, package_members
+import sniff
+
+
+outputs = ('summary', 'facts', 'timing')
+timing_columns = ['source', 'member', 'load_seconds', 'extract_seconds', 'status', 'error']
+shard_regex = re.compile(r'^(\d+)/(\d+)$')
+shard_file_regex = re.compile(r'^(?P<output>\w+)\.shard-(?P<index>\d+)-of-(?P<count>\d+)\.csv$')
+
+
+def read_manifest(path):
+    ''' Returns the list of sources in the manifest. '''
+    with open(path, newline='', encoding='utf-8') as file:
+        lines = [line.strip() for line in file]
+    lines = [line for line in lines if line and not line.startswith('#')]
+    if lines:
+        header = [name.strip().lower() for name in next(csv.reader([lines[0]]))]
+        if 'source' in header:
+            column = header.index('source')
+            return [row[column].strip() for row in csv.reader(lines[1:]) if len(row) > column and row[column].strip()]
+    return lines
+
+
+def parse_shard(text):
+    ''' Returns (index, count) from "i/n", with i counting from 1. '''
+    result = shard_regex.match(text.strip())
+    if not result:
+        raise ValueError(f'Shard must look like i/n, not {text!r}')
+    index, count = int(result.group(1)), int(result.group(2))
+    if not 1 <= index <= count:
+        raise ValueError(f'Shard index must be from 1 to {count}, not {index}')
+    return index, count
+
+
+def shard_entries(sources, index, count, sizes = None):
+    '''
+    Returns (manifest position, source) for the entries in shard index (from 1) of count.
+    With sizes (the size of each source, None if unknown), the entries are balanced by size and returned
+    largest first, otherwise dealt out in turn.
+    '''
+    if sizes is None:
+        return [(position, source) for position, source in enumerate(sources) if position % count == index - 1]
+
+    # Unknown sizes sort last, ties stay in manifest order.
+    order = sorted(range(len(sources)), key = lambda position: (sizes[position] is None, -(sizes[position] or 0)))
+    loads = [(0, 0, shard) for shard in range(1, count + 1)]   # (bytes, entries, shard)
+    entries = []
+    for position in order:
+        load, number, shard = min(loads)
+        loads[shard - 1] = (load + (sizes[position] or 0), number + 1, shard)
+        if shard == index:
+            entries.append((position, sources[position]))
+    return entries
+
+
+def sniff_source(source):
+    '''
+    Returns (size, is inline XBRL) for a source, from sniff.estimate: the decompressed size of its inline XBRL
+    documents, and whether it has any. (None, True) for a URL (or a file that doesn't exist), which can't be
+    sniffed.
+    '''
+    if source.startswith(('http://', 'https://')) or not os.path.isfile(source):
+        return None, True
+    try:
+        return sniff.estimate(source)
+    except sniff.read_errors:
+        # A damaged file is still processed, so its error shows up in the timing output.
+        return os.path.getsize(source), True
+
+
+def shard_path(out_dir, output, index, count):
+    return Path(out_dir, f'{output}.shard-{index}-of-{count}.csv')
+
+
+def source_members(source):
+    ''' Returns the member of each document in the source (None for a plain document or a URL). '''
+    if source.startswith(('http://', 'https://')):
+        return [None]
+    return package_members(path=source)
+
+
+def load_document(source, member):
+    if source.startswith(('http://', 'https://')):
+        return XbrliDocument(url=source)
+    return XbrliDocument(path=source, member=member)
+
+
+def process_source(position, source, spreadsheet):
+    '''
+    Loads and extracts each document in a source. Returns (summary rows, fact rows, timing rows),
+    each row starting with the manifest position and the document's order within the source.
+    A document that fails to load gets an error timing row, and the source's other documents still run.
+    '''
+    summary, facts, timing = [], [], []
+    start = time.perf_counter()
+    try:
+        members = source_members(source)
+    except Exception as e:
+        timing.append([position, 0, source, '', round(time.perf_counter() - start, 3), '', 'error', str(e)])
+        return summary, facts, timing
+
+    for order, member in enumerate(members):
+        start = time.perf_counter()
+        try:
+            doc = load_document(source, member)
+        except Exception as e:
+            timing.append([position, order, source, member or '', round(time.perf_counter() - start, 3), '',
+                           'error', str(e)])
+            continue
+        loaded = time.perf_counter()
+
+        try:
+            warn_conflicts(doc)
+            row = spreadsheet.summary_row(doc)
+            summary.append([position, order, doc.source] + row + spreadsheet.metric_values(row))
+            facts.extend([position, order] + list(row) for row in fact_rows(doc))
+            status, error = 'ok', ''
+        except Exception as e:
+            status, error = 'error', str(e)
+        timing.append([position, order, source, member or '', round(loaded - start, 3),
+                       round(time.perf_counter() - loaded, 3), status, error])
+
+        # Same as streaming in getix.py: free each parse tree before loading the next.
+        doc.close()
+        del doc
+        gc.collect()
+    return summary, facts, timing
+
+
+class ShardWriter:
+    ''' Appends rows to the three partial outputs of a shard. '''
+    def __init__(self, out_dir, index, count, fields):
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        headers = {
+            'summary': ['position', 'order', 'document'] + fields,
+            'facts': ['position', 'order'] + fact_columns,
+            'timing': ['position', 'order'] + timing_columns,
+        }
+        self.files = {}
+        self.writers = {}
+        for output in outputs:
+            self.files[output] = open(shard_path(out_dir, output, index, count), 'w', newline='', encoding='utf-8')
+            self.writers[output] = csv.writer(self.files[output])
+            self.writers[output].writerow(headers[output])
+
+    def write(self, output, rows):
+        self.writers[output].writerows(rows)
+        self.files[output].flush()
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+
+def run(manifest_path, shard = '1/1', out_dir = 'results', config_path = 'config.csv', sniff_inputs = True,
+        metrics_path = 'metrics.csv'):
+    ''' Processes this node's shard of the manifest and writes its partial outputs. '''
+    index, count = parse_shard(shard)
+    sources = read_manifest(manifest_path)
+    if sniff_inputs:
+        sniffed = [sniff_source(source) for source in sources]
+        sizes = [size for size, ixbrl in sniffed]
+    else:
+        sniffed = sizes = None
+    entries = shard_entries(sources, index, count, sizes)
+    spreadsheet = SummarySpreadsheet(config_path=config_path, stream=True, metrics_path=metrics_path)
+    # The metrics (see metrics.py) follow the output fields, as in getix.py's outputs.
+    fields = list(spreadsheet.output_fields) + [metric.name for metric in spreadsheet.metrics]
+
+    writer = ShardWriter(out_dir, index, count, fields)
+    try:
+        for number, (position, source) in enumerate(entries, start=1):
+            print(f'[{number}/{len(entries)}] {source}')
+            if sniffed and not sniffed[position][1]:
+                print(f'*** Skipping {source}: not inline XBRL')
+                writer.write('timing', [[position, 0, source, '', '', '', 'skipped', 'not inline XBRL']])
+                continue
+            summary, facts, timing = process_source(position, source, spreadsheet)
+            writer.write('summary', summary)
+            writer.write('facts', facts)
+            writer.write('timing', timing)
+    finally:
+        writer.close()
+    print(f'Shard {index}/{count} done: {len(entries)} sources')
+
+
+def merge(out_dir = 'results', merged_dir = None):
+    '''
+    Combines every shard's partial outputs into summary.csv, facts.csv and timing.csv in merged_dir
+    (out_dir by default), in manifest order. Raises ValueError if any shard's outputs are missing.
+    '''
+    merged_dir = Path(merged_dir or out_dir)
+    found = {}   # output: {index: path}
+    counts = set()
+    for path in Path(out_dir).iterdir():
+        result = shard_file_regex.match(path.name)
+        if result:
+            found.setdefault(result.group('output'), {})[int(result.group('index'))] = path
+            counts.add(int(result.group('count')))
+    if len(counts) != 1:
+        raise ValueError(f'Expected the shards of exactly one run in {out_dir}, found shard counts {sorted(counts)}')
+    count = counts.pop()
+
+    merged_dir.mkdir(parents=True, exist_ok=True)
+    for output in outputs:
+        missing = [index for index in range(1, count + 1) if index not in found.get(output, {})]
+        if missing:
+            raise ValueError(f'Missing {output} output for shards {missing} of {count}')
+
+        # Everything is read as strings so values are written back exactly as the shards wrote them.
+        frames = [pd.read_csv(found[output][index], dtype=str, keep_default_na=False) for index in range(1, count + 1)]
+        df = pd.concat(frames, ignore_index=True)
+        df['position'] = df['position'].astype(int)
+        df['order'] = df['order'].astype(int)
+        # A stable sort keeps each document's facts in their original order.
+        df = df.sort_values(['position', 'order'], kind='stable').drop(columns=['position', 'order'])
+        df.to_csv(merged_dir / f'{output}.csv', index=False)
+        print(f'Generated {merged_dir / f"{output}.csv"}')
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description='Sharded batch extraction of iXBRL filings.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="process one shard of a manifest")
+    run_parser.add_argument('manifest')
+    run_parser.add_argument('--shard', default='1/1', help='i/n, this node takes shard i of n (default 1/1)')
+    run_parser.add_argument('--out', default='results', help='shared output directory')
+    run_parser.add_argument('--config', default='config.csv')
+    run_parser.add_argument('--metrics', default='metrics.csv')
+    run_parser.add_argument('--no-sniff', action='store_true', help="don't balance by size or skip files that aren't inline XBRL")
+
+    merge_parser = commands.add_parser('merge', help="combine the shards' partial outputs")
+    merge_parser.add_argument('out', nargs='?', default='results')
+    merge_parser.add_argument('--to', default=None, help='directory for the merged outputs (default: the shard directory)')
+
+    args = parser.parse_args(args)
+    if args.command == 'run':
+        run(args.manifest, args.shard, args.out, args.config, not args.no_sniff, args.metrics)
+    else:
+        merge(args.out, args.to)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+'''
+benchmarks.py
+
+Measurements for the exports, run on the files given (the sample in test_data by default).
+
+    python benchmarks.py pivot [paths]
+    python benchmarks.py memory [paths] [--budgets budgets.csv]
+
+pivot: for each filing, the number of facts, axes and the most axes on one context, then the memory
+(DataFrame.memory_usage with deep=True) of the long and wide pivot exports (see pivot.py) with categorical
+columns, compared with the same tables as plain Python object columns, and how long each took to build.
+Filings whose contexts have more than two axes are the ones dumpix.py can't represent.
+
+memory: peak and retained memory for each stage of loading and exporting each filing, and for the whole
+batch (see memprofile.py). The budgets file lists limits as Stage,Measure,Budget (MB), for instance
+
+    parse tree,peak,10
+
+and the run fails (exit status 1) when any filing, or the batch, goes over one.
+'''
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from pandas import DataFrame
+
+import memprofile
+import pivot
+from getix import load_documents, release
+
+
+def default_paths():
+    return [str(path) for path in sorted(Path('test_data').iterdir())]
+
+
+def memory(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def pivot_benchmark(paths):
+    ''' Returns a DataFrame with a row per filing measuring the pivot exports. '''
+    rows = []
+    for doc in load_documents(paths):
+        facts, members = pivot.tables([doc])
+        axes_per_context = members.groupby('contextref', observed=True)['axis'].count()
+        row = {'document': doc.source,
+               'facts': len(facts),
+               'contexts': len(doc.contexts),
+               'axes': members['axis'].nunique(),
+               'max axes per context': int(axes_per_context.max()) if len(axes_per_context) else 0}
+        release(doc)
+
+        for layout, build in (('long', pivot.long_table), ('wide', pivot.wide_table)):
+            start = time.perf_counter()
+            df = build(facts, members)
+            row[f'{layout} seconds'] = round(time.perf_counter() - start, 4)
+            row[f'{layout} rows'] = len(df)
+            row[f'{layout} bytes'] = memory(df)
+            row[f'{layout} object bytes'] = memory(df.astype(object))
+        rows.append(row)
+    return DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the benchmarks.')
+    parser.add_argument('benchmark', choices=['pivot', 'memory'])
+    parser.add_argument('paths', nargs='*', help='iXBRL files (default: test_data)')
+    parser.add_argument('--out', default=None, help='also write the results to this CSV file')
+    parser.add_argument('--budgets', default='budgets.csv', help='memory budgets (memory benchmark only)')
+    args = parser.parse_args()
+    paths = args.paths or default_paths()
+
+    if args.benchmark == 'pivot':
+        results = pivot_benchmark(paths)
+        print(results.T.to_string(header=False))
+    else:
+        results = memprofile.profile_documents(paths)
+        print(results.round(2).to_string(index=False))
+    if args.out:
+        results.to_csv(args.out, index=False)
+
+    if args.benchmark == 'memory' and args.budgets:
+        messages = memprofile.over_budget(results, memprofile.load_budgets(args.budgets))
+        for message in messages:
+            print(f'*** Over budget: {message}')
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
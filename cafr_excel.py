@@ -1,9 +1,16 @@
+import argparse
 import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import xlwings as xw
 
 from ixbrl import Criterion, XbrliDocument
+from server import DocumentClient, select_values
 
 class Spreadsheet:
     ''' Represents an Excel spreadsheet using xlwings. '''
@@ -101,55 +108,155 @@ class CAFRSpreadsheet(Spreadsheet):
         return self._criteria
         
     
+# The refresh status (progress, errors and timing) goes in this cell, (row, column), 1-based.
+STATUS_CELL = (4, 1)
+
+def row_values(source, fields, server=None):
+    '''
+    Returns the values for one document: for each column (a list of query strings), the most recent period
+    matched by any of them (the last element found on a tie), '' if none.
+    Runs in the worker pool, so it only takes and returns plain values.
+    '''
+    if server:
+        # With CAFR_SERVER set to the address of a running server.py, the server parses and queries the
+        # documents and keeps them cached, so refreshing again doesn't parse them again.
+        return DocumentClient(server).select(fields, combine='latest', **source)
+
+    logging.debug(f"Loading document: {source}")
+    doc = XbrliDocument(**source)
+    try:
+        # The compiled query plans are shared across rows.
+        return select_values(doc, fields, combine='latest')
+    finally:
+        doc.close()
+
+class Refresh:
+    '''
+    Fetches, parses and matches the workbook's documents in a pool of workers, writing each row to the sheet
+    as soon as it's done (in whatever order they finish), with the progress in the status cell.
+
+    Threads are the default, since most of the time goes to downloading. With processes, parsing runs in
+    parallel too, at the cost of starting the processes.
+
+    run() checks for cancellation after each row, through the cancel file next to the workbook (see cancel()),
+    since the refresh runs in another process than the macro asking it to stop. Documents not started yet are
+    dropped, the rows already written stay.
+    '''
+    def __init__(self, excel, workers=4, processes=False, status_cell=STATUS_CELL):
+        self.excel = excel
+        self.workers = workers
+        self.processes = processes
+        self.status_cell = status_cell
+        self.server = os.environ.get('CAFR_SERVER') or None
+
+    def status(self, text):
+        self.excel.sheet.range(self.status_cell).value = text
+
+    def cancelled(self):
+        return cancel_path(self.excel.workbook).exists()
+
+    def run(self):
+        cancel_path(self.excel.workbook).unlink(missing_ok=True)
+
+        # Criterion's string form is valid query syntax.
+        fields = [[str(criterion) for criterion in crit_list] for crit_list in self.excel.criteria_for_columns]
+        urls = self.excel.urls
+        executor_class = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+        executor = executor_class(max_workers=self.workers)
+
+        start = time.perf_counter()
+        done = 0
+        errors = 0
+        self.status(f'Refreshing 0/{len(urls)}')
+        try:
+            futures = {executor.submit(row_values, document_source(url), fields, self.server): (url, index)
+                       for url, index in urls.items()}
+            for future in as_completed(futures):
+                url, index = futures[future]
+                done += 1
+                try:
+                    values = future.result()
+                except Exception as e:
+                    errors += 1
+                    logging.error(f"Unable to refresh {url}: {e}")
+                else:
+                    # Update the spreadsheet for this URL.
+                    logging.debug(f"Values for row: {values}")
+                    self.excel.sheet.range((index, 2)).value = values
+
+                elapsed = time.perf_counter() - start
+                failed = f', {errors} failed' if errors else ''
+                if self.cancelled():
+                    self.status(f'Cancelled at {done}/{len(urls)}{failed} after {elapsed:.1f}s')
+                    return
+                self.status(f'Refreshing {done}/{len(urls)}{failed}, {elapsed:.1f}s')
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        failed = f', {errors} failed' if errors else ''
+        self.status(f'Refreshed {done} in {time.perf_counter() - start:.1f}s{failed}')
+
 def update():
+    '''
+    Starts refreshing the workbook and returns right away, so Excel stays responsive. This is what the
+    workbook's Update button runs.
+
+    The refresh runs in a separate Python process (python cafr_excel.py --refresh), which connects to the open
+    workbook and writes the rows and the status cell as they're done. RunPython starts a new Python process
+    for each macro and waits for it, on Mac and on Windows without the UDF server, so a refresh running in
+    the macro's own process (or a thread of it) would keep Excel waiting until it's done.
+
+    For a refresh that returns when it's done (from a script or the debugger), use
+    Refresh(CAFRSpreadsheet()).run().
+    '''
     excel = CAFRSpreadsheet()
-    
-    for url, index in excel.urls.items():
-        if url.startswith('http'):
-            doc = XbrliDocument(url=url)
-        elif url.startswith('file'):            
-            path = url.replace('file:', '')
-            file = Path(path)
-            
-            '''
-            If it's a relative path, figure out the full path to the file.
-            When this script is called from Excel, the current working directory is the root directory (at least on Mac).
-            __file__ contains the script path.
-            '''
-            if not file.is_absolute():
-                script_path = Path(__file__).parent
-                path = Path(script_path, file).absolute()
-            
-            logging.debug(f"Loading document: {path}")
-            doc = XbrliDocument(path=path)
-        else:
-            raise ValueError(f"Unsupported URL: {url}")
+    command = [sys.executable, str(Path(__file__).resolve()), '--refresh', excel.workbook.fullname,
+               '--sheet', excel.sheet.name]
+    options = {}
+    if sys.platform == 'win32':
+        options['creationflags'] = subprocess.CREATE_NO_WINDOW
+    else:
+        # So it isn't stopped along with the macro's process.
+        options['start_new_session'] = True
+    excel.sheet.range(STATUS_CELL).value = 'Starting refresh'
+    subprocess.Popen(command, cwd=script_directory(), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, **options)
+
+def cancel():
+    '''
+    Stops the refresh in progress after the rows being worked on, by creating the cancel file it checks.
+    The workbook has no Cancel button, its Clear button also cancels (see clear()). A Cancel button would
+    run RunPython "import cafr_excel; cafr_excel.cancel()".
+    '''
+    cancel_path(CAFRSpreadsheet().workbook).touch()
+
+def cancel_path(workbook):
+    ''' The file that asks a refresh of this workbook to stop. '''
+    return Path(workbook.fullname).with_suffix('.cancel')
+
+def document_source(url):
+    ''' Returns the XbrliDocument arguments (url or path) for a URL from the workbook. '''
+    if url.startswith('http'):
+        return {'url': url}
+    elif url.startswith('file'):            
+        path = url.replace('file:', '')
+        file = Path(path)
         
-        values = []
-        for crit_list in excel.criteria_for_columns:
-            elements_found = []
-            for criterion in crit_list:
-                logging.debug(f"Checking criterion: {criterion}")
-                for element in doc.ix_elements:
-                    if criterion.matches_element(element):
-                        logging.debug(f"Matched: {element}")
-                        elements_found.append(element)
-                
-            if elements_found:
-                # Sort elements found by the context date (if any) and take the most recent date.
-                # If no context dates, this means returning the last element found.
-                elements_found.sort(key = lambda element: element.context.period)
-                logging.debug(f"Value: {elements_found[-1].string}")
-                values.append(elements_found[-1].string)        
-            else:
-                values.append('')
-
-        # Update the spreadsheet for this URL.
-        logging.debug(f"Values for row: {values}")
-        excel.sheet.range((index, 2)).value = values
+        '''
+        If it's a relative path, figure out the full path to the file.
+        When this script is called from Excel, the current working directory is the root directory (at least on Mac).
+        __file__ contains the script path.
+        '''
+        if not file.is_absolute():
+            script_path = Path(__file__).parent
+            path = Path(script_path, file).absolute()
+        return {'path': path}
+    else:
+        raise ValueError(f"Unsupported URL: {url}")
 
 def clear():
+    ''' Clears the values, cancelling a refresh in progress first so it doesn't write them again. '''
     excel = CAFRSpreadsheet()
+    cancel_path(excel.workbook).touch()
     for url, row in excel.urls.items():
         excel.sheet.range((row, 2)).expand('right').clear_contents()
 
@@ -160,9 +267,32 @@ def script_directory():
     path     = os.path.dirname(os.path.abspath(filename))
     return path
 
-if __name__ == '__main__':
+def main():
+    parser = argparse.ArgumentParser(description='Refreshes the CAFR workbook.')
+    parser.add_argument('--refresh', metavar='WORKBOOK', default=None,
+                        help='refresh this open workbook (what update() runs in the background)')
+    parser.add_argument('--sheet', default=None, help='the sheet to refresh (default: the first)')
+    parser.add_argument('--cancel', metavar='WORKBOOK', default=None, help='stop the refresh of this workbook')
+    args = parser.parse_args()
+
+    if args.cancel:
+        Path(args.cancel).resolve().with_suffix('.cancel').touch()
+        return
+    if args.refresh:
+        workbook = xw.Book(args.refresh)
+        excel = CAFRSpreadsheet(workbook, workbook.sheets[args.sheet] if args.sheet else None)
+        try:
+            Refresh(excel).run()
+        except Exception as e:
+            excel.sheet.range(STATUS_CELL).value = f'Refresh failed: {e}'
+            raise
+        return
+
     logging.basicConfig(level=logging.DEBUG)
-    
+
     # For debugging, can specify which file is the caller.
     xw.Book('cafr_excel.xlsm').set_mock_caller()
-    update()
+    Refresh(CAFRSpreadsheet()).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+'''
+checks.py
+
+Calculation consistency checks: does a total equal the weighted sum of its components?
+
+Rules come from a CSV file (see checks.csv) or from an XBRL calculation linkbase. Each rule has one total
+item and one or more component items. An item is a concept plus, optionally, explicit members as
+"axis=member" pairs, so a rule can sum concepts (as in a calculation linkbase) or the members of an axis
+(Committed + Assigned + Unassigned = total General Fund balance), or a mix of both:
+
+    Rule,Role,Concept,Members,Weight
+    General Fund Balance,total,us-cafr:FundBalances,us-cafr:TypeOfGovernmentalFundsAxis=us-cafr:GeneralFundMember,
+    General Fund Balance,component,us-cafr:FundBalances,us-cafr:TypeOfGovernmentalFundsAxis=us-cafr:GeneralFundMember us-cafr:TypeOfRestrictionAxis=us-cafr:CommittedMember,1
+
+A fact matches an item when its concept matches and, on the axes the rule mentions, it has exactly the item's
+members. Its other dimensions (and its period and document) must then be the same for the total and the
+components, so the rule above is checked separately for each period and for any other axis in the filing.
+
+Everything is evaluated with pandas merges and group-bys over the fact table (see facts.py) for the whole
+corpus at once, rather than document by document. Each side of the comparison is allowed its rounding,
+half a unit of its decimals (or of its scale when decimals is missing), so a rounded total isn't flagged.
+
+    python checks.py checks.csv test_data/*.xhtml
+    python checks.py checks.csv --facts results/facts.csv      # the merged output of batch.py
+'''
+
+import argparse
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+from pandas import DataFrame
+
+from facts import fact_table, with_document_index
+
+
+item_columns = ['rule', 'role', 'concept', 'members', 'weight']
+period_columns = ['period_type', 'start', 'end']
+key_columns = ['rule', 'document_index', 'document', 'dimensions'] + period_columns
+
+
+def load_rules(path):
+    ''' Reads the rules CSV into a DataFrame with the item_columns. '''
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    df.columns = [column.strip().lower() for column in df.columns]
+    df['role'] = df['role'].str.strip().str.lower()
+    df['weight'] = pd.to_numeric(df['weight'].replace('', '1'))
+    bad_roles = set(df['role']) - {'total', 'component'}
+    if bad_roles:
+        raise ValueError(f'Role must be total or component, not {sorted(bad_roles)}')
+    return df[item_columns]
+
+
+def concept_from_href(href):
+    ''' us-cafr-2019.xsd#us-cafr_FundBalances -> us-cafr:FundBalances '''
+    fragment = href.split('#')[-1]
+    prefix, _, name = fragment.partition('_')
+    return f'{prefix}:{name}' if name else fragment
+
+
+def rules_from_linkbase(path):
+    '''
+    Reads the calculation arcs of a calculation linkbase into rules: one per summation in each extended link,
+    named after its role and total concept. These are plain concept rules with no members.
+    '''
+    with open(path, 'rb') as file:
+        soup = BeautifulSoup(file, 'html.parser')
+
+    items = []
+    for link in soup.find_all('link:calculationlink'):
+        role = link.get('xlink:role', '')
+        concepts = {loc['xlink:label']: concept_from_href(loc['xlink:href']) for loc in link.find_all('link:loc')}
+        components = defaultdict(list)
+        for arc in link.find_all('link:calculationarc'):
+            components[arc['xlink:from']].append((arc['xlink:to'], float(arc.get('weight', 1))))
+        for total, arcs in components.items():
+            rule = f'{role.rsplit("/", 1)[-1]} {concepts[total]}'
+            items.append([rule, 'total', concepts[total], '', 1.0])
+            items.extend([rule, 'component', concepts[to], '', weight] for to, weight in arcs)
+    return DataFrame(items, columns=item_columns)
+
+
+def rounding_tolerance(facts):
+    ''' Half a unit of the last significant digit of each fact, from decimals (or scale when there's no decimals). '''
+    decimals = pd.to_numeric(facts['decimals'].astype(str).str.strip(), errors='coerce')
+    scale = pd.to_numeric(facts['scale'].astype(str).str.strip(), errors='coerce')
+    tolerance = 0.5 * np.power(10.0, -decimals)
+    tolerance = tolerance.fillna(0.5 * np.power(10.0, scale))
+    # INF decimals, or nothing to go on, means exact.
+    return tolerance.fillna(0.0)
+
+
+def dimension_pairs(series, id_name):
+    ''' Explodes canonical dimension strings into one (id, axis, member) row per pair. '''
+    pairs = series.str.split(' ').explode()
+    pairs = pairs[pairs.notna() & (pairs != '')]
+    if pairs.empty:
+        return DataFrame({id_name: pd.Series(dtype=int), 'axis': pd.Series(dtype=str), 'member': pd.Series(dtype=str)})
+    split = pairs.str.split('=', n=1, expand=True)
+    result = DataFrame({id_name: pairs.index, 'axis': split[0].to_numpy(), 'member': split[1].to_numpy()})
+    return result.reset_index(drop=True)
+
+
+def evaluate(facts, rules):
+    '''
+    Returns one row per rule, document, other dimensions and period where both the total and at least one
+    component were found, with the total, the weighted sum of the components, the difference and the tolerance.
+    '''
+    facts = with_document_index(facts)
+    numeric = facts[facts['value'].notna()]
+    # A fact repeated in a filing (same concept, dimensions, period and tuple) only counts once.
+    numeric = numeric.drop_duplicates(['document_index', 'concept', 'dimensions', 'tupleref', 'tuple_order']
+                                      + period_columns, keep='last')
+    numeric = numeric.reset_index(drop=True)
+    numeric['tolerance'] = rounding_tolerance(numeric)
+
+    items = rules.reset_index(drop=True)
+    items['item'] = items.index
+    item_pairs = dimension_pairs(items['members'].fillna(''), 'item').merge(items[['item', 'rule']], on='item')
+    items['pair_count'] = items['item'].map(item_pairs.groupby('item').size()).fillna(0).astype(int)
+    rule_axes = item_pairs[['rule', 'axis']].drop_duplicates()
+
+    fact_pairs = dimension_pairs(numeric['dimensions'], 'fact')
+
+    # Candidate (fact, item) pairs by concept.
+    matches = DataFrame({'fact': numeric.index, 'concept': numeric['concept']}).merge(
+        items[['item', 'rule', 'role', 'concept', 'weight', 'pair_count']], on='concept')
+
+    # On the rule's axes, the fact must have the item's members and nothing else.
+    on_rule_axes = fact_pairs.merge(rule_axes, on='axis')
+    counts = on_rule_axes.groupby(['fact', 'rule']).size().rename('on_rule_axes').reset_index()
+    matched = on_rule_axes.merge(item_pairs, on=['rule', 'axis', 'member'])
+    matched = matched.groupby(['fact', 'item']).size().rename('matched').reset_index()
+    matches = matches.merge(counts, on=['fact', 'rule'], how='left').merge(matched, on=['fact', 'item'], how='left')
+    matches[['on_rule_axes', 'matched']] = matches[['on_rule_axes', 'matched']].fillna(0)
+    matches = matches[(matches['matched'] == matches['pair_count']) & (matches['on_rule_axes'] == matches['pair_count'])]
+
+    # The dimensions not on the rule's axes have to line up between total and components.
+    other = fact_pairs.merge(matches[['fact', 'rule']].drop_duplicates(), on='fact')
+    other = other.merge(rule_axes.assign(on_axis=True), on=['rule', 'axis'], how='left')
+    other = other[other['on_axis'].isna()]
+    other = (other['axis'] + '=' + other['member']).groupby([other['fact'], other['rule']]).agg(' '.join)
+    other = other.rename('dimensions').reset_index()
+    matches = matches.merge(other, on=['fact', 'rule'], how='left')
+    matches['dimensions'] = matches['dimensions'].fillna('')
+
+    matches = matches.join(numeric[['document_index', 'document', 'value', 'tolerance'] + period_columns], on='fact')
+    matches['weighted'] = matches['value'] * matches['weight']
+
+    totals = matches[matches['role'] == 'total'].groupby(key_columns).agg(
+        total=('value', 'last'), total_tolerance=('tolerance', 'last'))
+    components = matches[matches['role'] == 'component'].groupby(key_columns).agg(
+        components=('weighted', 'sum'), component_tolerance=('tolerance', 'sum'), component_count=('item', 'nunique'))
+
+    result = totals.join(components, how='inner').reset_index()
+    result['difference'] = result['total'] - result['components']
+    result['tolerance'] = result['total_tolerance'] + result['component_tolerance']
+    result['ok'] = result['difference'].abs() <= result['tolerance']
+    return result[key_columns + ['total', 'components', 'difference', 'tolerance', 'component_count', 'ok']]
+
+
+def violations(facts, rules):
+    ''' The rows from evaluate that fail, sorted by filing. '''
+    result = evaluate(facts, rules)
+    return result[~result['ok']].drop(columns='ok').sort_values(['document_index', 'rule']).reset_index(drop=True)
+
+
+def read_fact_csv(path):
+    ''' Reads a fact table written to CSV (like the facts.csv from batch.py) back into fact table form. '''
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    df['value'] = pd.to_numeric(df['value'].replace('', np.nan), errors='coerce')
+    return df
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description='Checks that totals add up in iXBRL filings.')
+    parser.add_argument('rules', help='rules CSV, or a calculation linkbase (.xml)')
+    parser.add_argument('paths', nargs='*', help='iXBRL files')
+    parser.add_argument('--facts', help='fact table CSV, instead of loading the files')
+    parser.add_argument('--out', default=None, help='write the violations to this CSV')
+    args = parser.parse_args(args)
+
+    if args.rules.lower().endswith('.xml'):
+        rules = rules_from_linkbase(args.rules)
+    else:
+        rules = load_rules(args.rules)
+
+    if args.facts:
+        facts = read_fact_csv(args.facts)
+    else:
+        from ixbrl import XbrliDocument
+        facts = fact_table([XbrliDocument(path=path) for path in args.paths])
+
+    found = violations(facts, rules)
+    for _, rows in found.groupby('document_index', sort=False):
+        print(f'{rows["document"].iloc[0]}: {len(rows)} violations')
+        for row in rows.itertuples(index=False):
+            period = row.end if row.period_type == 'instant' else f'{row.start}..{row.end}'
+            dimensions = f' [{row.dimensions}]' if row.dimensions else ''
+            print(f'    {row.rule}{dimensions} {period}: total {row.total:,.0f}, '
+                  f'components {row.components:,.0f}, off by {row.difference:,.0f}')
+    if found.empty:
+        print('No violations')
+    if args.out:
+        found.to_csv(args.out, index=False)
+
+
+if __name__ == '__main__':
+    main()
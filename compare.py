@@ -0,0 +1,172 @@
+'''
+compare.py
+
+Compares facts across many XbrliDocuments, for example the same filer year over year, or a set of peers.
+
+Facts are aligned on (concept, dimensions, tuple, period type, period length, relative period), where the
+relative period is the number of years before the filing's own fiscal year end (0 is the current year, -1 the
+prior year shown in the same filing, and so on) and the period length is the number of days in a duration (0
+for instants), so a quarter and a year ending on the same day stay apart. The fiscal year end is the filing's
+us-cafr:FiscalEndDate, or its latest period end if it doesn't have one. The tuple is the tupleref and
+tuple_order, so facts repeated in several tuples aren't taken for duplicates. Each key is hashed to a single
+integer so alignment is a pandas pivot rather than pairwise matching, and the deltas and percent changes are
+computed on the whole matrix at once.
+
+    comparison = Comparison(docs)
+    comparison.values                 # aligned key x document matrix of numeric values
+    comparison.deltas()               # change from the first document (or base=label)
+    comparison.deltas(sequential=True)   # change from the previous document
+    comparison.percent_changes()
+    comparison.only_in_one            # keys found in a single filing, and which one
+'''
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from facts import fact_table, with_document_index
+
+
+key_columns = ['concept', 'dimensions', 'tupleref', 'tuple_order', 'period_type', 'period_days', 'period_offset']
+
+FISCAL_END_CONCEPT = 'us-cafr:FiscalEndDate'
+
+# Used for the relative period, a fiscal year a few days longer or shorter still rounds to whole years.
+DAYS_PER_YEAR = 365.25
+
+
+def period_days(facts):
+    ''' Returns the length in days of each fact's period, 0 for instants (and forever). '''
+    days = (pd.to_datetime(facts['end'], errors='coerce') - pd.to_datetime(facts['start'], errors='coerce')).dt.days
+    return days.fillna(0).astype(int)
+
+
+def document_labels(sources):
+    '''
+    Returns a distinct label for each document (by document_index) from its source: documents without a
+    source (loaded from a file object) are numbered, and a source loaded again gets its number added.
+    '''
+    labels = []
+    for index, source in enumerate(sources):
+        label = source or f'document {index + 1}'
+        if label in labels:
+            label = f'{label} ({index + 1})'
+        labels.append(label)
+    return labels
+
+
+def relative_periods(facts):
+    '''
+    Returns the period offset in years of each fact from its document's fiscal year end: the FiscalEndDate
+    fact when the document has one, otherwise the latest period end in the document.
+    '''
+    end = pd.to_datetime(facts['end'], errors='coerce')
+    fiscal = facts[facts['concept'] == FISCAL_END_CONCEPT]
+    # first skips the dates that don't parse.
+    fiscal_end = pd.to_datetime(fiscal['string'].str.strip(), errors='coerce')
+    fiscal_end = fiscal_end.groupby(fiscal['document_index']).first()
+    # reindex rather than map, which fails on an empty datetime Series (no document has the fact).
+    document_end = pd.Series(fiscal_end.reindex(facts['document_index']).to_numpy(), index=facts.index)
+    document_end = document_end.fillna(end.groupby(facts['document_index']).transform('max'))
+    offset = ((end - document_end).dt.days / DAYS_PER_YEAR).round()
+    return offset.fillna(0).astype(int)
+
+
+class Comparison:
+    def __init__(self, docs = [], labels = None, facts = None):
+        '''
+        docs is a list of XbrliDocuments (or pass an existing fact table from facts.fact_table as facts).
+        labels optionally names each document in the output, it defaults to the document source.
+
+        Documents are told apart by their position (document_index), not their source, so two documents
+        loaded from file objects (no source), or the same path loaded twice, are still compared. The labels
+        are only for display, and must be distinct.
+        '''
+        if facts is None:
+            facts = fact_table(docs)
+        facts = with_document_index(facts).reset_index(drop=True)
+
+        # Column order follows the document order, not alphabetical order.
+        indexes = list(dict.fromkeys(facts['document_index']))
+        if labels:
+            if len(set(labels)) != len(labels) or len(labels) <= max(indexes, default=-1):
+                raise ValueError(f'Document labels must be distinct, one for each document: {labels}')
+            names = {index: labels[index] for index in indexes}
+        else:
+            sources = facts.drop_duplicates('document_index').set_index('document_index')['document']
+            count = max(indexes) + 1 if indexes else 0
+            names = dict(enumerate(document_labels([sources.get(index, '') for index in range(count)])))
+        facts['document'] = facts['document_index'].map(names)
+        self.labels = [names[index] for index in indexes]
+
+        facts['period_days'] = period_days(facts)
+        facts['period_offset'] = relative_periods(facts)
+        facts['key'] = pd.util.hash_pandas_object(facts[key_columns], index=False).to_numpy()
+        self.facts = facts
+
+    @property
+    def keys(self):
+        ''' The key columns for each hashed key. '''
+        try:
+            return self._keys
+        except AttributeError:
+            self._keys = self.facts.drop_duplicates('key').set_index('key')[key_columns]
+        return self._keys
+
+    @property
+    def presence(self):
+        ''' Boolean key x document matrix, True where the document has a fact for the key. '''
+        try:
+            return self._presence
+        except AttributeError:
+            counts = self.facts.groupby(['key', 'document']).size().unstack(fill_value=0)
+            self._presence = counts.reindex(columns=self.labels, fill_value=0) > 0
+        return self._presence
+
+    @property
+    def values(self):
+        ''' Numeric key x document matrix. A repeated fact within a document keeps its last value. '''
+        try:
+            return self._values
+        except AttributeError:
+            numeric = self.facts.dropna(subset=['value']).drop_duplicates(['key', 'document'], keep='last')
+            values = numeric.pivot(index='key', columns='document', values='value')
+            self._values = values.reindex(columns=self.labels)
+        return self._values
+
+    def deltas(self, base = None, sequential = False):
+        ''' Change in value from the base document (first by default), or from the previous document with sequential. '''
+        values = self.values
+        if sequential:
+            return values.diff(axis=1)
+        base = self.labels[0] if base is None else base
+        return values.sub(values[base], axis=0)
+
+    def percent_changes(self, base = None, sequential = False):
+        ''' Deltas as a percentage of the base value (NaN where the base is zero or missing). '''
+        values = self.values
+        if sequential:
+            reference = values.shift(1, axis=1)
+        else:
+            base = self.labels[0] if base is None else base
+            reference = DataFrame(np.repeat(values[[base]].to_numpy(), len(self.labels), axis=1),
+                                  index=values.index, columns=values.columns)
+        return self.deltas(base, sequential) / reference.abs().replace(0, np.nan) * 100
+
+    @property
+    def only_in_one(self):
+        ''' Keys that appear in exactly one filing, with the filing they appear in. '''
+        presence = self.presence
+        single = presence[presence.sum(axis=1) == 1]
+        result = self.keys.loc[single.index].copy()
+        result['document'] = single.idxmax(axis=1)
+        return result
+
+    def to_frame(self, base = None, sequential = False):
+        ''' Returns one long table with the key columns, each document's value, delta and percent change. '''
+        values = self.values
+        deltas = self.deltas(base, sequential).add_suffix(' delta')
+        percents = self.percent_changes(base, sequential).add_suffix(' %')
+        combined = pd.concat([values, deltas, percents], axis=1)
+        ordered = [column for label in self.labels for column in (label, f'{label} delta', f'{label} %')]
+        return self.keys.join(combined[ordered], how='inner').reset_index(drop=True)
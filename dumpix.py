@@ -1,21 +1,34 @@
+import argparse
+import gc
 import pandas as pd
 from pandas import Series, DataFrame, Index
 from decimal import Decimal
-from ixbrl import XbrliDocument
+from ixbrl import XbrliDocument, fact_classes
+from journal import Journal
 
 ixbrl_files = ['https://xbrlus.github.io/cafr/samples/20/Los_Angeles-20180630.htm', \
 'https://xbrlus.github.io/cafr/samples/21/San_Diego-20180630.htm', \
 'https://xbrlus.github.io/cafr/samples/22/Columbus-20171231.htm']
 
-context = pd.DataFrame(columns=['contextref','dimension1','memberstring1','dimension2','memberstring2','instant','StartDate','EndDate'])
-ixdata = pd.DataFrame(columns=['document','itemname','contextref','value'])
+context_columns = ['contextref','dimension1','memberstring1','dimension2','memberstring2','instant','StartDate','EndDate']
+ixdata_columns = ['document','itemname','contextref','value','unit','tupleref','order']
+
+# With --journal, each document's rows are recorded as it's done (see journal.py),
+# so a run that dies part way can be restarted without fetching and parsing those documents again.
+parser = argparse.ArgumentParser(description='Dumps all the facts in the iXBRL files to CSV.')
+parser.add_argument('--journal', default=None, help='journal file for checkpoint and resume')
+args = parser.parse_args()
+journal = Journal(args.journal) if args.journal else None
 
 def display(text):
     ''' Returns a display-friendly version of the text. '''
     return text.replace('us-cafr:','').replace('Axis','').replace('Member','')
 
-for fileloc in ixbrl_files:
+def extract(fileloc):
+    ''' Returns (context rows, ixdata rows) for a document, as lists of dictionaries. '''
     ixbrl_doc = XbrliDocument(url=fileloc)
+    context_rows = []
+    ixdata_rows = []
 
     for context_obj in ixbrl_doc.contexts.values():
         dimension1 = dimension2 = memberstring1 = memberstring2 = ''
@@ -28,21 +41,61 @@ for fileloc in ixbrl_files:
                 dimension2 = display(explicitmember.dimension)
                 memberstring2 = display(explicitmember.string)
 
-        context = context.append({'contextref': context_obj.id, 
-                                  'dimension1': dimension1, 
-                                  'memberstring1': memberstring1, 
-                                  'dimension2': dimension2, 
-                                  'memberstring2': memberstring2,
-                                  'instant': context_obj.instant, 
-                                  'StartDate': context_obj.start_date, 
-                                  'EndDate': context_obj.end_date}, ignore_index=True)
+        if len(context_obj.explicit_members) > 2:
+            # Only two fit in the columns, pivot.py exports any number of axes.
+            print(f'*** Warning: {fileloc}: context {context_obj.id} has {len(context_obj.explicit_members)} explicit members, only the first two are kept (see pivot.py)')
+
+        context_rows.append({'contextref': context_obj.id, 
+                             'dimension1': dimension1, 
+                             'memberstring1': memberstring1, 
+                             'dimension2': dimension2, 
+                             'memberstring2': memberstring2,
+                             'instant': context_obj.instant, 
+                             'StartDate': context_obj.start_date, 
+                             'EndDate': context_obj.end_date})
 
     for ix_element in ixbrl_doc.ix_elements:
-        if ix_element.tag.name.startswith('ix:non'):
-            ixdata = ixdata.append({'document': fileloc, 
-                                    'itemname': display(ix_element.name), 
-                                    'contextref' : ix_element.contextref, 
-                                    'value': ix_element.string}, ignore_index=True)
+        if isinstance(ix_element, fact_classes):
+            unit = ix_element.unit
+            ixdata_rows.append({'document': fileloc, 
+                                'itemname': display(ix_element.name), 
+                                'contextref' : ix_element.contextref, 
+                                'value': ix_element.string,
+                                'unit': unit.measure if unit else '',
+                                'tupleref': ix_element.tupleref or '',
+                                'order': ix_element.order})
+
+    ixbrl_doc.close()
+    gc.collect()
+    return context_rows, ixdata_rows
+
+context_rows = []
+ixdata_rows = []
+for fileloc in ixbrl_files:
+    entry = journal.completed(fileloc) if journal else None
+    if entry:
+        print(f'Already done {fileloc}')
+        document_contexts, document_ixdata = entry['rows']
+    else:
+        try:
+            document_contexts, document_ixdata = extract(fileloc)
+        except Exception as e:
+            if not journal:
+                raise e
+            # Recorded so the restarted run tries it again, the other documents can still be done now.
+            print(f'*** Error: {fileloc}: {e}')
+            journal.record(fileloc, status='error', error=str(e))
+            continue
+        if journal:
+            journal.record(fileloc, rows=[document_contexts, document_ixdata])
+    context_rows.extend(document_contexts)
+    ixdata_rows.extend(document_ixdata)
+
+if journal:
+    journal.close()
+
+context = DataFrame(context_rows, columns=context_columns)
+ixdata = DataFrame(ixdata_rows, columns=ixdata_columns)
 
 ixdata.to_csv('ixdata.csv', index=False)
 taxonomy_extract = pd.read_csv('TaxonomyExtract.csv', encoding='windows-1252')
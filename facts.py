@@ -0,0 +1,88 @@
+'''
+facts.py
+
+Flattens XbrliDocuments into a columnar fact table (a pandas DataFrame with one row per fact),
+which is what the bulk operations (comparison, checks, exports) work on instead of the element objects.
+
+Columns:
+- document_index: the document's position in the list of documents, which identifies it (fact_table only,
+  fact_rows leaves it to the caller)
+- document: the document's source (path or url), for display: documents loaded from a file object have no
+  source, and the same path can be loaded twice
+- concept: the fact name, like us-cafr:NetPosition
+- contextref, unit, decimals, scale
+- tupleref, tuple_order: the tupleID of the tuple the fact belongs to and its order attribute, empty outside
+  tuples. Facts of one concept in different tuples (or at different positions of one tuple) are different facts.
+- dimensions: the explicit and typed members as a canonical string, "axis=member" pairs sorted and space separated
+- period_type: instant, duration or forever
+- start, end: ISO date strings (end is the instant for instant contexts)
+- string: the fact value as returned by the element
+- value: the numeric value (NaN for non-numeric facts)
+'''
+
+import pandas as pd
+from pandas import DataFrame
+
+from ixbrl import IXFraction, IXNonFraction, fact_classes
+
+
+columns = ['document', 'concept', 'contextref', 'dimensions', 'period_type', 'start', 'end',
+           'unit', 'decimals', 'scale', 'tupleref', 'tuple_order', 'string', 'value']
+
+
+def dimension_key(context):
+    ''' Returns the canonical dimension string for a context, "" when it has no explicit members. '''
+    if context is None:
+        return ''
+    pairs = [f'{axis}={member}' for axis, member in context.dimensions.items()]
+    pairs.extend(f'{axis}={value}' for axis, value in context.typed_members.items())
+    return ' '.join(sorted(pairs))
+
+
+def period_of(context):
+    ''' Returns (period_type, start, end) for a context. '''
+    if context is None:
+        return 'forever', '', ''
+    if context.instant:
+        return 'instant', '', context.instant
+    if context.end_date:
+        return 'duration', context.start_date, context.end_date
+    return 'forever', '', ''
+
+
+def fact_rows(doc):
+    ''' Yields one tuple per fact in the document, in the order of columns. '''
+    source = doc.source
+    for element in doc.ix_elements:
+        if not isinstance(element, fact_classes):
+            continue
+        context = doc.contexts.get(element.tag.get('contextref'))
+        period_type, start, end = period_of(context)
+        unit = element.unit
+        string = element.string
+        yield (source, element.name, element.tag.get('contextref', ''), dimension_key(context), period_type, start, end,
+               unit.measure if unit else '', element.tag.get('decimals', ''), element.tag.get('scale', ''),
+               element.tupleref or '', element.tag.get('order', ''),
+               string, string if isinstance(element, (IXNonFraction, IXFraction)) else None)
+
+
+def fact_table(docs):
+    ''' Returns the fact table for a list of documents, with the document_index column first. '''
+    rows = []
+    for index, doc in enumerate(docs):
+        rows.extend((index,) + row for row in fact_rows(doc))
+    df = DataFrame.from_records(rows, columns=['document_index'] + columns)
+    df['value'] = pd.to_numeric(df['value'], errors='coerce')
+    return df
+
+
+def with_document_index(facts):
+    '''
+    Returns the fact table with a document_index column. A table without one (read back from a CSV file, like
+    batch.py's facts.csv) numbers its documents by source, in order of appearance.
+    '''
+    if 'document_index' in facts.columns:
+        return facts
+    facts = facts.copy()
+    facts.insert(0, 'document_index', pd.factorize(facts['document'])[0])
+    return facts
@@ -38,76 +38,332 @@ from pandas import Series, DataFrame
 import pandas as pd
 import numpy as np
 import datetime
+import csv
+import gc
+import hashlib
+from pathlib import Path
 
 # In Python 3.7, dict is automatically ordered, but to allow for people using previous versions,
 # need to use an OrderedDict or the results will be messy.
 from collections import OrderedDict
 
-from ixbrl import Criterion, XbrliDocument
+from ixbrl import Criterion, XbrliDocument, package_members
+from journal import Journal, content_hash
+from metrics import add_metrics, load_metrics, usable_metrics
+from query import compile_query
+from server import DocumentClient
 
 
 
-class InputCriteria:
-    ''' Represents input criteria for an output field from config.csv. '''
-    # cafr:CashAndCashEquivalents (cafr:AccrualBasisOfAccountingMember cafr:GovernmentalTypeActivityMember cafr:PrimaryGovernmentActivitiesMember)
-    regex = re.compile(r'(.*?)\s*\((.*?)\)')
-    
-    def __init__(self, text):
-        result = self.regex.search(text)
-        try:
-            self.name = result.group(1)
-            self.required_members = result.group(2).split()
-        except:
-            # Some criteria, such as cafr:DocumentName, don't have context info.
-            self.name = text
-            self.required_members = []
-            
-    def matches_element(self, element):
-        try:
-            if element.name != self.name:
-                return False
-        except:
-            return False
-        
-        # Fails if no formal context definition was provided, in which case we just try to match the contextref attribute.
+def load_documents(paths = [], urls = []):
+    ''' Yields each document in turn, so callers decide whether to keep them. '''
+    # Paths can be compressed or zipped, a zip (or report package) can hold several documents.
+    for path in paths:
+        for member in package_members(path=path):
+            print(f'Loading {path}{" " + member if member else ""}...')
+            doc = XbrliDocument(path=path, member=member)
+            warn_conflicts(doc)
+            yield doc
+
+    for url in urls:
+        print(f'Downloading {url}...')
         try:
-            context_members = element.context.explicit_members
+            doc = XbrliDocument(url=url)
         except:
-            context_members = [element.tag['contextref']]
-            
-        for member in self.required_members:
-            if member not in context_members:
-                return False
-        return True
+            continue
+        warn_conflicts(doc)
+        yield doc
+
+
+def release(doc):
+    ''' Frees the parse tree now rather than whenever the garbage collector gets to it,
+        otherwise several documents' trees can pile up. Collecting costs far less than parsing. '''
+    doc.close()
+    gc.collect()
+
+
+def warn_conflicts(doc):
+    for name, members, period_key, values in doc.duplicate_conflicts:
+        print(f'*** Warning: {doc.source}: {name} ({" ".join(sorted(members))}) ending {period_key[0]} has conflicting values {values}')
+
 
+class CSVRowWriter:
+    ''' Writes summary rows to a CSV file as they are produced. '''
+    def __init__(self, path, fields, **options):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        # Same line endings as DataFrame.to_csv, so streamed and normal output are identical.
+        self.writer = csv.writer(self.file, lineterminator='\n')
+        self.writer.writerow(fields)
 
+    def write_row(self, values):
+        self.writer.writerow(values)
+
+    def close(self):
+        self.file.close()
+
+
+class ExcelRowWriter:
+    ''' Writes summary rows to an Excel file as they are produced, using XlsxWriter's constant memory mode
+        (each row is flushed to disk once the next one starts). '''
+    def __init__(self, path, fields, number_format='#,##0', col_width=45, freeze_cols=3, formulas={}, **options):
+        ''' formulas maps a column index to the Metric written as a live formula in that column. '''
+        import xlsxwriter
+        self.workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        self.worksheet = self.workbook.add_worksheet('Sheet1')
+        self.worksheet.set_column(0, len(fields) - 1, col_width, self.workbook.add_format({'num_format': number_format}))
+        if freeze_cols:
+            self.worksheet.freeze_panes(0, freeze_cols)
+        header_format = self.workbook.add_format({'bold': True, 'border': 1})
+        self.worksheet.write_row(0, 0, fields, header_format)
+        self.formulas = formulas
+        self.field_columns = {field: index for index, field in enumerate(fields)}
+        self.formula_format = self.workbook.add_format({'bg_color': 'yellow', 'num_format': '0.00'})
+        self.row_index = 1
+
+    def write_row(self, values):
+        # Same idea as to_excel: numbers need to be numbers, not strings, to get the number format.
+        for col_index, value in enumerate(values):
+            if col_index in self.formulas:
+                formula = self.formulas[col_index].excel_formula(self.field_columns, self.row_index)
+                self.worksheet.write_formula(self.row_index, col_index, formula, self.formula_format)
+                continue
+            try:
+                self.worksheet.write_number(self.row_index, col_index, float(value.replace(',', '')))
+            except (AttributeError, ValueError):
+                self.worksheet.write(self.row_index, col_index, value)
+        self.row_index += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+class ParquetRowWriter:
+    ''' Writes summary rows to a Parquet file in row groups of batch_size rows (needs pyarrow).
+        The columns are strings, as in the CSV, since their types aren't known until every row is seen,
+        apart from float_fields (the metrics), which are doubles. '''
+    def __init__(self, path, fields, batch_size=1000, float_fields=(), **options):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.fields = fields
+        self.schema = pa.schema([(field, pa.float64() if field in float_fields else pa.string()) for field in fields])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.batch_size = batch_size
+        self.rows = []
+
+    def write_row(self, values):
+        self.rows.append(values)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            columns = [[row[index] for row in self.rows] for index in range(len(self.fields))]
+            self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+# Output format for each file extension in streaming mode.
+row_writers = {
+    '.csv': CSVRowWriter,
+    '.xlsx': ExcelRowWriter,
+    '.parquet': ParquetRowWriter,
+}
 
 
 class SummarySpreadsheet:    
-    def __init__(self, paths = [], urls = [], config_path = 'config.csv'):
+    def __init__(self, paths = [], urls = [], config_path = 'config.csv', fiscal_year = None, stream = False,
+                 journal_path = None, metrics_path = 'metrics.csv', server = None):
+        '''
+        Normally all documents are loaded up front and kept in docs.
+
+        With stream, nothing is loaded here. Instead each output method (or stream_to, for several outputs
+        in one pass) loads one document at a time, writes its row and releases it, so memory doesn't grow
+        with the number of documents. Streaming needs the config file, since the columns must be known
+        before the first row is written.
+
+        With journal_path, each document's row (or error) is recorded in a journal (see journal.py) as it is
+        processed, and documents already recorded as done are not loaded again, so a run that died can be
+        restarted. Documents are processed one at a time like with stream, and a document that fails is
+        recorded and skipped rather than stopping the run.
+
+        The derived metrics in metrics_path (see metrics.py) are added as columns after the output fields.
+        Metrics using fields that aren't in the config file are skipped with a warning.
+
+        With server (the address of a running server.py), the documents are parsed and queried by the server,
+        which keeps them cached between runs, so nothing is loaded here. Like streaming, it needs the config file.
+        '''
         self.paths = paths
         self.urls = urls
         self.config_path = config_path
+        self.metrics_path = metrics_path
+        self.fiscal_year = fiscal_year
+        self.stream = stream
+        self.journal = Journal(journal_path) if journal_path else None
+        self.server = DocumentClient(server) if server else None
         self.docs = []
         
         # Load all specified documents.
-        for path in paths:
-            print(f'Loading {path}...')
-            doc = XbrliDocument(path=path)
-            self.docs.append(doc)
+        if not stream and not self.journal and not self.server:
+            self.docs = list(load_documents(paths, urls))
+
+    def close(self):
+        ''' Closes the journal, if any. '''
+        if self.journal:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
 
-        for url in urls:
-            print(f'Downloading {url}...')
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def iter_rows(self):
+        ''' Yields the summary row for each document, in order, loading documents one at a time unless already loaded. '''
+        if self.docs:
+            for doc in self.docs:
+                yield self.summary_row(doc)
+        elif self.journal:
+            yield from self._journaled_rows()
+        elif self.server:
+            yield from self._server_rows()
+        else:
+            for doc in load_documents(self.paths, self.urls):
+                row = self.summary_row(doc)
+                release(doc)
+                yield row
+
+    def _journaled_rows(self):
+        # The settings are part of the hash, so changing the config or fiscal year redoes the documents.
+        settings = repr([(name, [str(query) for query in inputs]) for name, inputs in self.output_fields.items()])
+        settings += repr(self.fiscal_year)
+
+        sources = []
+        for path in self.paths:
+            file_hash = content_hash(path) if Path(path).exists() else None
+            for member in (package_members(path=path) if file_hash else [None]):
+                sources.append((f'{path}!{member}' if member else str(path), file_hash, dict(path=path, member=member)))
+        for url in self.urls:
+            # Not downloaded again just to hash it, a URL that succeeded stays done.
+            sources.append((url, None, dict(url=url)))
+
+        for source, file_hash, arguments in sources:
+            hash = hashlib.sha256(f'{file_hash}{settings}'.encode()).hexdigest()
+            entry = self.journal.completed(source, hash)
+            if entry:
+                print(f'Already done {source}')
+                yield entry['rows'][0]
+                continue
+
+            print(f'Loading {source}...')
             try:
-                doc = XbrliDocument(url=url)
-                self.docs.append(doc)
-            except:
-                pass
+                doc = XbrliDocument(**arguments)
+                warn_conflicts(doc)
+                row = self.summary_row(doc)
+                release(doc)
+            except Exception as e:
+                print(f'*** Error: {source}: {e}')
+                self.journal.record(source, hash, 'error', error=str(e))
+                continue
+            self.journal.record(source, hash, 'ok', [row])
+            yield row
+
+    def _server_rows(self):
+        fields = [[str(query) for query in inputs] for inputs in self.output_fields.values()]
+        if not fields:
+            raise ValueError(f'Using a server needs the output fields in {self.config_path}')
+        for path in self.paths:
+            for member in package_members(path=path):
+                yield self.server.select(fields, path=path, member=member, year=self.fiscal_year)
+        for url in self.urls:
+            print(f'Querying {url}...')
+            try:
+                yield self.server.select(fields, url=url, year=self.fiscal_year)
+            except Exception as e:
+                # Same as loading directly: a URL that can't be loaded is skipped.
+                print(f'*** Error: {url}: {e}')
+
+    def stream_to(self, *output_paths, metric_formulas=False, **options):
+        '''
+        Writes a summary row per document to each output path (.csv, .xlsx or .parquet), loading and
+        releasing the documents one at a time. Options are passed to the row writers (like number_format).
+        The metrics are computed as each row is written, and with metric_formulas the Excel output
+        gets them as formulas instead.
+        '''
+        fields = list(self.output_fields)
+        if not fields:
+            raise ValueError(f'Streaming needs the output fields in {self.config_path}')
+        metric_names = [metric.name for metric in self.metrics]
+        # The metrics are numbers, the other fields strings, as in the DataFrame outputs.
+        options['float_fields'] = metric_names
+        if metric_formulas:
+            options['formulas'] = {len(fields) + index: metric for index, metric in enumerate(self.metrics)}
+
+        writers = []
+        try:
+            for path in output_paths:
+                suffix = Path(path).suffix.lower()
+                if suffix not in row_writers:
+                    raise ValueError(f'Unsupported output format: {path}')
+                writers.append(row_writers[suffix](path, fields + metric_names, **options))
+
+            for row in self.iter_rows():
+                row = row + self.metric_values(row)
+                for writer in writers:
+                    writer.write_row(row)
+        finally:
+            for writer in writers:
+                writer.close()
+
+    def metric_values(self, row):
+        ''' Returns the metrics for a single summary row, as floats (None when there's no value). '''
+        if not self.metrics:
+            return []
+        df = add_metrics(DataFrame([row], columns=list(self.output_fields)), self.metrics)
+        return [None if pd.isna(value) else float(value) for value in df.iloc[0, len(row):]]
+
+    def summary_row(self, doc):
+        ''' Returns the value of each output field for the document (empty string when nothing matches). '''
+        row = []
+        for output_name, inputs in self.output_fields.items():
+            # The criteria may match more than one element in the document. In that case,
+            # choose the most recent period (or the latest one in fiscal_year, if given).
+            # Equal periods go to the last element found.
+            # The documents keep their facts in period order, so this is a lookup, not a sort.
+            for criteria in inputs:
+                fact = criteria.select(doc, self.fiscal_year)
+                if fact is not None:
+                    row.append(fact.string)
+                    break
+            else:
+                # If no value for this output field, need an empty value.
+                row.append('')
+        return row
 
     def to_csv(self, path='output.csv'):
+        if self.stream:
+            self.stream_to(path)
+            return
         self.dataframe.to_csv(path, index=False)
 
-    def to_excel(self, path='output.xlsx', number_format='#,##0', col_width=45, freeze_cols=3):
+    def to_parquet(self, path='output.parquet'):
+        if self.stream:
+            self.stream_to(path)
+            return
+        self.dataframe.to_parquet(path, index=False)
+
+    def to_excel(self, path='output.xlsx', number_format='#,##0', col_width=45, freeze_cols=3, metric_formulas=True):
+        ''' With metric_formulas, the metric columns are Excel formulas over the field columns, so they follow edits
+            in the workbook. Otherwise they hold the computed values. '''
+        if self.stream:
+            self.stream_to(path, number_format=number_format, col_width=col_width, freeze_cols=freeze_cols,
+                           metric_formulas=metric_formulas)
+            return
+
         # To have numbers not be treated as strings in the Excel file, have to specify the type of the column.
         # Easy approach is to just try turning each column into a numeric column and see if it works
         # (it will fail if any value is not a number).
@@ -131,60 +387,55 @@ class SummarySpreadsheet:
         workbook  = writer.book
         worksheet = writer.sheets['Sheet1']
 
-        # Add at the right the following calculation:  
-        #    General Fund Balance / General Fund Expenditure with the title General Fund Balance Ratio.  
-        #    The formula would be R2 / T2 where 2 is replaced by the row number.  
-        col_index = num_cols
+        # The metrics (see metrics.csv) are at the right, highlighted.
+        # As formulas, the cell references come from the columns the fields are in, e.g. =R2/T2 for row 2.
         header_format = workbook.add_format({'align': 'center', 'bold': True, 'bg_color':'yellow', 'bottom':True, 'left':True, 'right':True})
-        worksheet.write(0, col_index, 'General Fund Balance Ratio', header_format)
-        
         formula_format = workbook.add_format({'bg_color':'yellow', 'num_format': '0.00'})
-        for row_index in range(1,num_rows+1):
-            # Excel indexes are 1-based.
-            worksheet.write(row_index, col_index, f'=R{row_index+1} / T{row_index+1}', formula_format)
+        field_columns = {field: index for index, field in enumerate(self.output_fields)}
+        for metric_index, metric in enumerate(self.metrics):
+            col_index = num_cols + metric_index
+            worksheet.write(0, col_index, metric.name, header_format)
+            for row_index in range(1, num_rows+1):
+                if metric_formulas:
+                    worksheet.write_formula(row_index, col_index, metric.excel_formula(field_columns, row_index), formula_format)
+                else:
+                    value = df[metric.name].iloc[row_index-1]
+                    if pd.isna(value):
+                        worksheet.write_blank(row_index, col_index, None, formula_format)
+                    else:
+                        worksheet.write_number(row_index, col_index, value, formula_format)
         
         # Apply column width and number format to all columns.
         num_format = workbook.add_format({'num_format': number_format})
-        worksheet.set_column(0, num_cols, col_width, num_format)
+        worksheet.set_column(0, num_cols + len(self.metrics) - 1, col_width, num_format)
 
         # Freeze the specified number of columns.
         if freeze_cols:
             worksheet.freeze_panes(0, freeze_cols)
         
         # Close the Pandas Excel writer and output the Excel file.
-        writer.save()       
+        writer.close()
 
     @property
     def dataframe(self):
-        # Build up data dictionary to become DataFrame.
-        sheet_data = OrderedDict()
-        
-        # For each output field, go through each doc and get the value based on input fields
-        for output_name, inputs in self.output_fields.items():
-            values = []
-            for doc in self.docs:
-                # NOW:
-                # The criteria may match more than one element in the document. In that case,
-                # if the matching elements have a date in their contexts, choose the most recent date.
-                # Otherwise choose the last element found.
-                for criteria in inputs:
-                    elements_found = []
-                    for element in doc.ix_elements:
-                        if criteria.matches_element(element):
-                            elements_found.append(element)
-                            
-                    if elements_found:
-                        # Sort elements found by the context date (if any) and take the most recent date.
-                        # If no context dates, this means returning the last element found.
-                        elements_found.sort(key = lambda element: element.context.period)
-                        values.append(elements_found[-1].string)
-                        break
-                    
-                # If no value for this output field, need an empty value.
-                if not elements_found:
-                    values.append('')
-            sheet_data[output_name] = values         
-        return DataFrame(sheet_data)
+        # One row per doc, with a value for each output field based on its input fields.
+        # The metrics are then computed over whole columns.
+        rows = list(self.iter_rows())
+        df = DataFrame.from_records(rows, columns=list(self.output_fields))
+        return add_metrics(df, self.metrics)
+
+    @property
+    def metrics(self):
+        '''
+        The derived metrics from metrics_path (none if the file doesn't exist), leaving out those that use
+        fields the config file doesn't have.
+        '''
+        try:
+            return self._metrics
+        except AttributeError:
+            metrics = load_metrics(self.metrics_path) if self.metrics_path else []
+            self._metrics = usable_metrics(metrics, self.output_fields)
+        return self._metrics
 
     @property
     def output_fields(self):
@@ -201,7 +452,9 @@ class SummarySpreadsheet:
         to allow multiple Input Field Names tied to the same output name.
         In that case, only the first matching Input Field Name will be used for a document.
 
-        Returns a dictionary with the output field name as the key and a list of InputCriteria objects as the value.
+        The Input Field Name is a query (see query.py), the config.csv syntax above is the simplest form of it.
+
+        Returns a dictionary with the output field name as the key and a list of compiled Query objects as the value.
         '''
         try:
             return self._output_fields
@@ -213,13 +466,13 @@ class SummarySpreadsheet:
             df = pd.read_csv(self.config_path)
             for output_name, input_name in df.itertuples(index=False):
                 inputs = self._output_fields.setdefault(output_name, [])
-                inputs.append(InputCriteria(input_name))
+                inputs.append(compile_query(input_name))
         except FileNotFoundError:
             for doc in self.docs:
-                for key in doc.ix_fields:
+                for key in doc.facts_by_name:
                     if key not in self._output_fields:
-                        # The input names list in this case just uses the key name.
-                        self._output_fields[key] = [key]
+                        # The input query in this case is just the concept name.
+                        self._output_fields[key] = [compile_query(key)]
         return self._output_fields
     
     def _to_numeric(self, iterable, downcast='signed'):
@@ -240,18 +493,26 @@ class SummarySpreadsheet:
 # In[265]:
 
 
-def main(paths=None):
-    ''' For development, pass a list of paths and urls will be skipped. '''
+def main(paths=None, stream=False, journal_path=None):
+    ''' For development, pass a list of paths and urls will be skipped. 
+        With stream, documents are processed one at a time and both outputs are written in one pass.
+        With journal_path, a restarted run picks up where the last one stopped. '''
     if paths:
-        spreadsheet = SummarySpreadsheet(paths=paths)
+        spreadsheet = SummarySpreadsheet(paths=paths, stream=stream, journal_path=journal_path)
     else:
-        spreadsheet = SummarySpreadsheet(urls=urls)
-    
-    spreadsheet.to_csv()
-    print('Generated output.csv')
+        spreadsheet = SummarySpreadsheet(urls=urls, stream=stream, journal_path=journal_path)
     
-    spreadsheet.to_excel()
-    print('Generated output.xlsx')
+    with spreadsheet:
+        if stream:
+            spreadsheet.stream_to('output.csv', 'output.xlsx')
+            print('Generated output.csv and output.xlsx')
+            return
+
+        spreadsheet.to_csv()
+        print('Generated output.csv')
+        
+        spreadsheet.to_excel()
+        print('Generated output.xlsx')
 
 
 # In[266]:
@@ -260,13 +521,15 @@ def main(paths=None):
 def test():
     from pathlib import Path
     
-    paths = [str(path) for path in Path('test_data').iterdir() if '.xhtml' in str(path) or '.htm' in str(path)]
+    suffixes = ('.xhtml', '.htm', '.gz', '.zip')
+    paths = [str(path) for path in Path('test_data').iterdir() if any(suffix in str(path) for suffix in suffixes)]
     main(paths)
 
 
 # In[267]:
 
 
-#main()
-test()
+if __name__ == '__main__':
+    #main()
+    test()
 
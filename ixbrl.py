@@ -11,9 +11,16 @@ Libraries
 - BeautifulSoup: https://www.crummy.com/software/BeautifulSoup/bs4/doc/
 '''
 
+import codecs
+import gzip
+import html
+import io
 import re
+import zipfile
 import requests
 from bs4 import BeautifulSoup
+from bs4.element import Comment, Declaration, Doctype, ProcessingInstruction, Tag
+import bisect
 import datetime
 
 
@@ -31,6 +38,7 @@ class Element:
     def __init__(self, tag, doc):
         self.tag = tag
         self.doc = doc   # This should be a weakref, but that wasn't working w/property, need to investigate.
+        self.parent_tuple = None   # Filled in by XbrliDocument when it indexes tuples.
     
     @property
     def name(self):
@@ -49,6 +57,28 @@ class Element:
     def context(self):
         return self.doc.contexts[self.contextref]
 
+    @property
+    def unitref(self):
+        return self.tag.get('unitref')
+
+    @property
+    def unit(self):
+        ''' The XBRLIUnit for this fact, or None for facts without a unit. '''
+        return self.doc.units.get(self.unitref)
+
+    @property
+    def tupleref(self):
+        ''' The tupleID of the tuple this fact belongs to, or None. '''
+        if self.parent_tuple is not None:
+            return self.parent_tuple.tuple_id
+        return None
+
+    @property
+    def order(self):
+        ''' The order attribute (position within the parent tuple) as a float, or None. '''
+        order = self.tag.get('order')
+        return float(order) if order is not None else None
+
 
 # In[246]:
 
@@ -73,6 +103,11 @@ class IXHeader(Element):
             contexts.append(context_class(tag, self.doc))
         return contexts
 
+    @property
+    def units(self):
+        unit_class = element_classes['xbrli:unit']
+        return [unit_class(tag, self.doc) for tag in self.tag.find_all({'xbrli:unit'})]
+
 
 # In[247]:
 class XBRLDIExplicitMember(Element):
@@ -104,6 +139,62 @@ class XBRLIContext(Element):
                 member = XBRLDIExplicitMember(member_tag, self.doc)
                 self._explicit_members[member.string] = member
         return self._explicit_members
+
+    @property
+    def typed_members(self):
+        ''' Returns a dictionary of axis: value (both strings) for the typed members. '''
+        try:
+            return self._typed_members
+        except AttributeError:
+            self._typed_members = {tag['dimension']: tag.get_text().strip() for tag in self.tag({'xbrldi:typedmember'})}
+        return self._typed_members
+
+    @property
+    def dimensions(self):
+        ''' Returns a dictionary of axis: member (both strings) for the explicit members. '''
+        try:
+            return self._dimensions
+        except AttributeError:
+            self._dimensions = {member.dimension: name for name, member in self.explicit_members.items()}
+        return self._dimensions
+
+    @property
+    def period_type(self):
+        ''' instant, duration or forever. '''
+        if self.instant:
+            return 'instant'
+        if self.end_date:
+            return 'duration'
+        return 'forever'
+
+    @property
+    def period_end(self):
+        ''' The instant or end date as a datetime.date, None for forever contexts. '''
+        try:
+            return self._period_end
+        except AttributeError:
+            end = self.instant or self.end_date
+            self._period_end = datetime.date.fromisoformat(end.strip()) if end else None
+        return self._period_end
+
+    @property
+    def period_key(self):
+        '''
+        A sortable key for the period: (end date, length in days).
+        Instants have length 0, and for the same end date a longer duration sorts later, so the annual figure
+        wins over a quarter ending the same day. Forever contexts sort first.
+        '''
+        try:
+            return self._period_key
+        except AttributeError:
+            end = self.period_end
+            if end is None:
+                self._period_key = (datetime.date.min, 0)
+            elif self.start_date:
+                self._period_key = (end, (end - datetime.date.fromisoformat(self.start_date.strip())).days)
+            else:
+                self._period_key = (end, 0)
+        return self._period_key
  
     @property
     def start_date(self):
@@ -157,19 +248,172 @@ class XBRLIContext(Element):
             return self._period
 
 
+# The period key for facts without a formal context.
+NO_PERIOD = (datetime.date.min, 0)
+
+
+class FactSeries:
+    '''
+    The facts for one concept and dimension set, with one fact per period, ordered by period key
+    (see XBRLIContext.period_key).
+
+    Built once when the document loads, so the latest period is the last entry and a fiscal year or
+    a date range is a bisect, with no sorting per query.
+
+    When more than one fact has the same period, the last one in the document is used (which is what
+    the old sort-and-take-last selection did). The duplicates are kept in duplicates, and the ones with
+    different values (see facts_agree) are reported in XbrliDocument.duplicate_conflicts.
+
+    Facts in different tuples are different facts, so each tuple's facts get their own series, and so do
+    repeated items of one concept in the same tuple, told apart by their order.
+    '''
+    def __init__(self, name, members, dimensions, typed_members = {}, parent_tuple = None, order = None):
+        self.name = name
+        self.parent_tuple = parent_tuple    # the IXTuple the facts belong to, if any
+        self.order = order                  # their order within the tuple, if any
+        self.members = members              # frozenset of explicit member names (or the contextref, with no context)
+        self.dimensions = dimensions        # axis: member
+        self.typed_members = typed_members  # axis: value
+        self.keys = []                 # period keys, sorted
+        self.facts = []                # the fact for each period key
+        self.duplicates = {}           # period key: all facts with that period, only for repeated periods
+
+    def __repr__(self):
+        return f'FactSeries({self.name} ({" ".join(sorted(self.members))}), {len(self.keys)} periods)'
+
+    @property
+    def latest(self):
+        return self.facts[-1] if self.facts else None
+
+    def for_year(self, year):
+        ''' The fact for the latest period ending in the given year, or None. '''
+        index = bisect.bisect_right(self.keys, (datetime.date(year, 12, 31), float('inf'))) - 1
+        if index >= 0 and self.keys[index][0].year == year:
+            return self.facts[index]
+        return None
+
+    def between(self, start = None, end = None):
+        ''' The facts with a period end from start to end (inclusive, either can be None), in period order. '''
+        low = bisect.bisect_left(self.keys, (start, -1)) if start else 0
+        high = bisect.bisect_right(self.keys, (end, float('inf'))) if end else len(self.keys)
+        return self.facts[low:high]
+
+
+class XBRLIUnit(Element):
+    '''
+    The xbrli:unit element, either a list of measures or a divide of numerator and denominator measures.
+
+    <xbrli:unit id="USD"><xbrli:measure>iso4217:USD</xbrli:measure></xbrli:unit>
+    '''
+    @property
+    def id(self):
+        return self.tag['id']
+
+    @property
+    def measure(self):
+        ''' The measures as a string, like iso4217:USD, or iso4217:USD/xbrli:shares for a divide. '''
+        try:
+            return self._measure
+        except AttributeError:
+            pass
+
+        def measures(tag):
+            return '*'.join(measure.string.strip() for measure in tag({'xbrli:measure'}) if measure.string)
+
+        divide = self.tag.find('xbrli:divide')
+        if divide:
+            self._measure = f"{measures(divide.find('xbrli:unitnumerator'))}/{measures(divide.find('xbrli:unitdenominator'))}"
+        else:
+            self._measure = measures(self.tag)
+        return self._measure
+
+
 # In[248]:
 
 
-class IXContinuation(Element):
+def content_text(tag, escape=False):
+    '''
+    Returns the content of a tag as a string, leaving out anything inside ix:exclude.
+
+    With escape, the XHTML markup is kept (ix elements themselves are dropped but their content isn't),
+    otherwise just the text nodes are concatenated.
+    '''
+    parts = []
+    for child in tag.children:
+        if isinstance(child, Tag):
+            if child.name == 'ix:exclude':
+                continue
+            if escape and not child.name.startswith('ix:'):
+                attributes = ''.join(f' {key}="{html.escape(" ".join(value) if isinstance(value, list) else value)}"'
+                                     for key, value in child.attrs.items())
+                parts.append(f'<{child.name}{attributes}>{content_text(child, escape)}</{child.name}>')
+            else:
+                parts.append(content_text(child, escape))
+        elif not isinstance(child, (Comment, Declaration, Doctype, ProcessingInstruction)):
+            parts.append(html.escape(child, quote=False) if escape else str(child))
+    return ''.join(parts)
+
+
+class ContinuedElement(Element):
+    '''
+    Base for the elements whose content can carry on in ix:continuation elements (ix:footnote, ix:nonNumeric
+    and ix:continuation itself).
+
+    The text value is resolved once and cached: the content minus ix:exclude, followed by each continuation
+    in the continuedAt chain. Continuations are looked up in the document's id index, so a chain costs
+    one dictionary lookup per hop rather than a search of the tree.
+    '''
+    escape_default = False
+
+    @property
+    def continued_at(self):
+        return self.tag.get('continuedat')
+
+    @property
+    def escape(self):
+        ''' True if the content is XHTML markup that should be preserved. '''
+        value = self.tag.get('escape')
+        if value is None:
+            return self.escape_default
+        return value.strip().lower() in ('true', '1')
+
+    @property
+    def string(self):
+        try:
+            return self._string
+        except AttributeError:
+            pass
+
+        escape = self.escape
+        parts = [content_text(self.tag, escape)]
+
+        # Guard against a continuedAt loop in a malformed document.
+        seen = set()
+        continued_at = self.continued_at
+        while continued_at and continued_at not in seen:
+            seen.add(continued_at)
+            continuation = self.doc.continuations.get(continued_at)
+            if continuation is None:
+                break
+            parts.append(content_text(continuation.tag, escape))
+            continued_at = continuation.continued_at
+
+        self._string = ''.join(parts)
+        return self._string
+
+
+class IXContinuation(ContinuedElement):
     '''
-    The ix:continuation element is used to define data that is to be treated as part of 
+    The ix:continuation element is used to define data that is to be treated as part of
     ix:footnote or ix:nonNumeric elements.
-    
+
     <ix:continuation continuedAt = NCName id = NCName>
     Content: ( any element | any text node )*
     </ix:continuation>
     '''
-    pass
+    @property
+    def id(self):
+        return self.tag['id']
 
 
 # In[249]:
@@ -190,7 +434,7 @@ class IXExclude(Element):
 # In[250]:
 
 
-class IXFootnote(Element):
+class IXFootnote(ContinuedElement):
     '''
     The ix:footnote element represents the link:footnote element.
     
@@ -204,12 +448,47 @@ class IXFootnote(Element):
     Content: ( any element | any text node ) +
     </ix:footnote>
     '''
-    pass
+    # Footnote content is XHTML, so its markup is kept.
+    escape_default = True
 
 
 # In[251]:
 
 
+def number_value(text, scale=None, sign=None):
+    ''' Returns the number shown in text (commas removed) with scale and sign applied, or None if it isn't a number. '''
+    try:
+        number = float(text.replace(',', ''))
+    except (AttributeError, ValueError):
+        return None
+    if scale:
+        number *= 10 ** int(scale)
+    if sign == '-':
+        number = -number
+    return number
+
+
+def facts_agree(facts):
+    '''
+    True if duplicate facts report the same value. Numbers are compared after rounding to the lowest
+    decimals among them, so 1,234,000 (decimals -3) and 1,234,321 (decimals 0) agree. Anything else
+    is compared by its string.
+    '''
+    if all(isinstance(fact, IXNonFraction) for fact in facts):
+        values = [number_value(fact.string) for fact in facts]
+        if None not in values:
+            decimals = []
+            for fact in facts:
+                try:
+                    decimals.append(int(fact.tag.get('decimals')))
+                except (TypeError, ValueError):
+                    pass   # Missing or INF, exact.
+            if decimals:
+                values = [round(value, min(decimals)) for value in values]
+            return len(set(values)) == 1
+    return len({fact.string for fact in facts}) == 1
+
+
 class IXFraction(Element):
     '''
     The ix:fraction element denotes an XBRL fact which is an element of type, or derived from type, fractionItemType.
@@ -227,7 +506,35 @@ class IXFraction(Element):
     Content: ( any text node | any children with a namespace name which has a value other than http://www.xbrl.org/2013/inlineXBRL | ix:fraction | ix:denominator | ix:numerator ) +
     </ix:fraction>
     '''
-    pass
+    def _part(self, name):
+        ''' The numerator or denominator element of this fraction (not of a nested one). '''
+        for tag in self.tag.find_all(name):
+            if tag.find_parent('ix:fraction') is self.tag:
+                return self.doc.element_for_tag(tag)
+        return None
+
+    @property
+    def numerator(self):
+        part = self._part('ix:numerator')
+        return part.value if part is not None else None
+
+    @property
+    def denominator(self):
+        part = self._part('ix:denominator')
+        return part.value if part is not None else None
+
+    @property
+    def value(self):
+        ''' The numerator divided by the denominator, or None if either is missing (such as a nil fraction). '''
+        numerator, denominator = self.numerator, self.denominator
+        if numerator is None or not denominator:
+            return None
+        return numerator / denominator
+
+    @property
+    def string(self):
+        value = self.value
+        return '' if value is None else str(value)
 
 
 # In[252]:
@@ -244,7 +551,9 @@ class IXDenominator(Element):
     Content: ( non-empty text node )
     </ix:denominator>
     '''
-    pass
+    @property
+    def value(self):
+        return number_value(self.tag.string, self.tag.get('scale'), self.tag.get('sign'))
 
 
 # In[253]:
@@ -261,7 +570,9 @@ class IXNumerator(Element):
     Content: ( non-empty text node )
     </ix:numerator>
     '''
-    pass
+    @property
+    def value(self):
+        return number_value(self.tag.string, self.tag.get('scale'), self.tag.get('sign'))
 
 
 # In[254]:
@@ -341,7 +652,7 @@ class IXNonFraction(Element):
 # In[256]:
 
 
-class IXNonNumeric(Element):
+class IXNonNumeric(ContinuedElement):
     '''
     The ix:nonNumeric element denotes an XBRL non-numeric item.
     
@@ -432,7 +743,14 @@ class IXTuple(Element):
     Content: ( any children with a namespace name which has a value other than http://www.xbrl.org/2013/inlineXBRL | ix:fraction | ix:nonFraction | ix:nonNumeric | ix:tuple | any text node ) *
     </ix:tuple>
     '''
-    pass
+    @property
+    def tuple_id(self):
+        return self.tag.get('tupleid')
+
+    @property
+    def members(self):
+        ''' The facts and tuples in this tuple, sorted by their order attribute. '''
+        return self.doc.tuple_members.get(self, [])
 
 
 # In[261]:
@@ -454,9 +772,13 @@ element_classes = {
     'ix:relationship': IXRelationship,
     'ix:resources': IXResources,
     'ix:tuple': IXTuple,
-    'xbrli:context': XBRLIContext
+    'xbrli:context': XBRLIContext,
+    'xbrli:unit': XBRLIUnit
 }
 
+# The elements that are XBRL facts (as opposed to structure like ix:header or ix:continuation).
+fact_classes = (IXFraction, IXNonFraction, IXNonNumeric)
+
 
 # In[262]:
 
@@ -499,29 +821,297 @@ class Criterion:
                 return False
         return True
 
-class XbrliDocument:
-    def __init__(self, path = None, url = None):
-        if path:
-            with open(path,'r', encoding='latin1') as source:
-                try:
-                    html = source.read()
-                except Exception as e:
-                    print(f'*** Error: Unable to read {path}: {e}')
-                    raise e
-        elif url:
+# In[263]:
+
+# Sources can be plain, gzip-compressed, or zipped (including XBRL report packages, which keep
+# their inline documents under a reports/ directory). The magic bytes decide, not the file extension.
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+DOCUMENT_SUFFIXES = ('.xhtml', '.html', '.htm')
+
+# Only the start of the document is inspected when looking for an encoding declaration.
+SNIFF_SIZE = 4096
+encoding_regexes = [
+    re.compile(rb'<\?xml[^>]*?encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']', re.IGNORECASE),
+    re.compile(rb'<meta[^>]*?charset\s*=\s*["\']?([A-Za-z0-9._-]+)', re.IGNORECASE),
+]
+
+
+class PrefixedStream(io.RawIOBase):
+    ''' A binary stream that replays bytes already read from the front of another stream, then continues with it.
+        This lets us sniff a stream that can't seek (like a download or a zip member) without buffering all of it. '''
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            count = min(len(buffer), len(self.prefix))
+            buffer[:count] = self.prefix[:count]
+            self.prefix = self.prefix[count:]
+            return count
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def detect_encoding(head, default='utf-8'):
+    ''' Returns the encoding declared at the start of the document (BOM, XML declaration or meta charset). '''
+    if head.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
+    if head.startswith(b'\xff\xfe') or head.startswith(b'\xfe\xff'):
+        return 'utf-16'
+    for regex in encoding_regexes:
+        result = regex.search(head)
+        if result:
+            encoding = result.group(1).decode('ascii')
             try:
-                html = requests.get(url).text
-            except Exception as e:
-                print(f'*** Error: Unable to read {url}: {e}')
-                raise e
+                return codecs.lookup(encoding).name
+            except LookupError:
+                pass
+    return default
+
+
+def document_members(zip_file):
+    ''' Returns the names of the inline XBRL documents inside a zip file or report package.
+        Documents under a reports/ directory come first, since that's where report packages put them. '''
+    names = [name for name in zip_file.namelist() if name.lower().endswith(DOCUMENT_SUFFIXES)]
+    names.sort(key = lambda name: 'reports' not in name.lower().split('/')[:-1])
+    return names
+
+
+def open_binary(path = None, url = None, file = None):
+    ''' Returns a binary stream for the given source, without reading all of it. '''
+    if path:
+        return open(path, 'rb')
+    elif url:
+        response = requests.get(url, stream=True)
+        response.raise_for_status()
+        # Let urllib3 undo any Content-Encoding, a .gz file served as-is is still handled by the magic bytes.
+        response.raw.decode_content = True
+        return response.raw
+    elif file:
+        return file
+    raise Exception("Need a path, url or file argument!")
+
+
+def read_head(source):
+    ''' Returns (stream, first bytes) for a binary stream, with gzip undone, so the bytes can be checked for a zip. '''
+    head = source.read(len(ZIP_MAGIC))
+    if head.startswith(GZIP_MAGIC):
+        source = gzip.GzipFile(fileobj=PrefixedStream(head, source))
+        head = source.read(len(ZIP_MAGIC))
+    return source, head
+
+
+def zip_stream(source, head):
+    ''' Returns a stream ZipFile can read, given a stream whose first bytes (head) were already read.
+        Zip needs random access to find its directory, so sources that can't seek get buffered in memory,
+        and so do gzip streams, which can't seek from the end. '''
+    if isinstance(source, gzip.GzipFile) or not (hasattr(source, 'seekable') and source.seekable()):
+        return io.BytesIO(head + source.read())
+    source.seek(0)
+    return source
+
+
+def open_document(source, member = None):
+    ''' 
+    Returns (text stream, encoding) for a binary stream containing an iXBRL document.
+    
+    Gzip and zip are decompressed as they are read, so nothing is written to disk.
+    For zips, member selects the document, otherwise the first one found is used.
+    '''
+    source, head = read_head(source)
+    if head.startswith(ZIP_MAGIC):
+        zip_file = zipfile.ZipFile(zip_stream(source, head))
+        if member is None:
+            members = document_members(zip_file)
+            if not members:
+                raise ValueError("No inline XBRL document found in zip file")
+            member = members[0]
+        source = zip_file.open(member)
+        head = b''
+
+    head += source.read(SNIFF_SIZE)
+    encoding = detect_encoding(head)
+    stream = io.BufferedReader(PrefixedStream(head, source))
+    return io.TextIOWrapper(stream, encoding=encoding, errors='replace'), encoding
+
+
+def package_members(path = None, url = None, file = None):
+    ''' Returns the document names inside a zip source (which can be gzip-compressed), or [None] for a
+        single-document source. Each entry can be passed as the member argument of XbrliDocument.
+        A file is read from its current position and put back there, so it has to be seekable. '''
+    if file is not None:
+        if not (hasattr(file, 'seekable') and file.seekable()):
+            raise ValueError('package_members needs a seekable file, it would use up the stream')
+        start = file.tell()
+    raw = open_binary(path, url, file)
+    try:
+        source, head = read_head(raw)
+        if not head.startswith(ZIP_MAGIC):
+            return [None]
+        return document_members(zipfile.ZipFile(zip_stream(source, head)))
+    finally:
+        if file is None:
+            raw.close()
         else:
-            raise Exception("Need a path or url argument!")
-        
+            file.seek(start)
+
+
+class XbrliDocument:
+    def __init__(self, path = None, url = None, file = None, member = None, checkpoint = None):
+        '''
+        Loads the document from a path, a url, or a binary file-like object.
+        Any of them can be gzip-compressed or a zip/report package (use member to pick the document).
+
+        checkpoint, if given, is called with the name of each loading stage as it finishes: 'raw html',
+        'parse tree', 'ix_elements', 'contexts' and 'indexes'. memprofile.py uses it to measure each stage.
+        '''
+        checkpoint = checkpoint or (lambda stage: None)
+        try:
+            source = open_binary(path, url, file)
+        except Exception as e:
+            print(f'*** Error: Unable to read {path or url or file}: {e}')
+            raise e
+
         self.path = path
+        self.url = url
+        self.member = member
+
+        try:
+            text, self.encoding = open_document(source, member)
+            html_text = text.read()
+            self.text_size = len(html_text)   # Characters, a rough guide to how much memory the document takes.
+            checkpoint('raw html')
+            soup = BeautifulSoup(html_text, 'html.parser')
+            # The tree has its own copy of the text, no need to hold on to both while indexing.
+            del html_text
+        except Exception as e:
+            print(f'*** Error: Unable to read {path or url or file}: {e}')
+            raise e
+        finally:
+            if not file:
+                source.close()
+        checkpoint('parse tree')
 
-        soup = BeautifulSoup(html, 'html.parser')
         self.ix_elements = [element_classes[tag.name](tag, self) for tag in soup.find_all({re.compile(r'^ix:')})]
+
+        # Index continuations by id up front, so resolving a continuedAt chain never searches the tree.
+        self.continuations = {element.id: element for element in self.ix_elements if isinstance(element, IXContinuation)}
+
+        # Same for units and tuples, so a fact's unit or parent tuple is a lookup rather than a search.
+        self.units = {unit.id: unit for unit in (self.header.units if self.header else [])}
+        self._index_tuples()
+        checkpoint('ix_elements')
+
+        self.contexts
+        checkpoint('contexts')
+
+        # Facts by concept name, in document order, which is where queries start.
+        self.facts_by_name = {}
+        for position, element in enumerate(self.ix_elements):
+            element.position = position   # Document order, for breaking ties between equal periods.
+            if isinstance(element, fact_classes):
+                self.facts_by_name.setdefault(element.name, []).append(element)
+
+        self._index_series()
+        checkpoint('indexes')
+
+    def _index_series(self):
+        '''
+        Groups the facts by concept and dimension set into FactSeries (series_by_name), resolving
+        duplicate periods once here rather than in every query.
+        '''
+        self.series_by_name = {}
+        self.duplicate_conflicts = []   # (concept, members, period key, [values]) for duplicates that disagree
+        contexts = self.contexts
+        for name, elements in self.facts_by_name.items():
+            grouped = {}   # (explicit members, typed members, parent tuple, order): (series, {period key: [facts]})
+            for element in elements:
+                contextref = element.tag.get('contextref')
+                context = contexts.get(contextref)
+                if context is None:
+                    members, dimensions, typed, period_key = frozenset([contextref]), {}, {}, NO_PERIOD
+                else:
+                    members, dimensions, typed = frozenset(context.explicit_members), context.dimensions, context.typed_members
+                    period_key = context.period_key
+                order = element.order if element.parent_tuple is not None else None
+                key = (members, frozenset(typed.items()), element.parent_tuple, order)
+                if key not in grouped:
+                    grouped[key] = (FactSeries(name, members, dimensions, typed, element.parent_tuple, order), {})
+                grouped[key][1].setdefault(period_key, []).append(element)
+
+            series_list = []
+            for series, periods in grouped.values():
+                series.keys = sorted(periods)
+                series.facts = [periods[key][-1] for key in series.keys]
+                for key in series.keys:
+                    facts = periods[key]
+                    if len(facts) > 1:
+                        series.duplicates[key] = facts
+                        if not facts_agree(facts):
+                            values = [fact.string for fact in facts]
+                            self.duplicate_conflicts.append((name, series.members, key, values))
+                series_list.append(series)
+            self.series_by_name[name] = series_list
                 
+    def _index_tuples(self):
+        '''
+        Sets parent_tuple on every fact and tuple that belongs to a tuple, and fills in tuple_members
+        (keyed by the IXTuple, since nested tuples don't need a tupleID).
+        Membership is either by a tupleRef attribute or by being nested inside the ix:tuple.
+        '''
+        self._elements_by_tag = {id(element.tag): element for element in self.ix_elements}
+        self.tuples = {element.tuple_id: element for element in self.ix_elements
+                       if isinstance(element, IXTuple) and element.tuple_id}
+        self.tuple_members = {}
+        for element in self.ix_elements:
+            if not isinstance(element, fact_classes + (IXTuple,)):
+                continue
+            tupleref = element.tag.get('tupleref')
+            if tupleref:
+                element.parent_tuple = self.tuples.get(tupleref)
+            else:
+                parent_tag = element.tag.find_parent('ix:tuple')
+                if parent_tag is not None:
+                    element.parent_tuple = self._elements_by_tag.get(id(parent_tag))
+            if element.parent_tuple is not None:
+                self.tuple_members.setdefault(element.parent_tuple, []).append(element)
+
+        for members in self.tuple_members.values():
+            # Members without an order keep document order, after the ordered ones.
+            members.sort(key = lambda element: (element.order is None, element.order or 0))
+
+    def element_for_tag(self, tag):
+        ''' Returns the Element wrapping a BeautifulSoup ix tag. '''
+        return self._elements_by_tag.get(id(tag))
+
+    def close(self):
+        '''
+        Drops the references to the parse tree and indexes. The tree is full of reference cycles,
+        so it is only freed by the cyclic garbage collector; callers processing many documents
+        should run gc.collect() after closing each one to keep memory flat.
+        '''
+        self.ix_elements = []
+        self.continuations = {}
+        self.units = {}
+        self.tuples = {}
+        self.tuple_members = {}
+        self.facts_by_name = {}
+        self.series_by_name = {}
+        self._elements_by_tag = {}
+        self._contexts = {}
+
+    @property
+    def source(self):
+        ''' A label for where the document came from (path or url, plus the zip member if any). '''
+        source = str(self.path or self.url or '')
+        return f'{source}!{self.member}' if self.member else source
+
     @property
     def header(self):
         ''' The header element for the document. '''
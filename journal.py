@@ -0,0 +1,83 @@
+'''
+journal.py
+
+A per-document results journal, so a long getix.py or dumpix.py run that dies part way can be restarted
+without redoing the documents that already succeeded.
+
+The journal is a JSON Lines file with one entry appended (and flushed to disk) per document:
+
+    {"source": ..., "hash": ..., "status": "ok" or "error", "rows": [...], "error": ..., "time": ...}
+
+On a restart, a document whose latest entry is "ok" with the same content hash is skipped and its recorded
+rows are used instead, documents that failed are tried again. Since the outputs are built from the rows in
+source order either way, they come out the same as an uninterrupted run.
+
+URLs are not downloaded again just to hash them, so a URL that succeeded is skipped by its source alone.
+'''
+
+import datetime
+import hashlib
+import json
+import os
+
+
+def content_hash(path, chunk_size=1 << 20):
+    ''' Returns the sha256 of a file's bytes, reading it in chunks. '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}   # source: latest entry
+        if os.path.exists(path):
+            with open(path, 'r+b') as file:
+                data = file.read()
+                if data and not data.endswith(b'\n'):
+                    # A line cut short by the crash we're recovering from. It's dropped from the file too,
+                    # otherwise the next entry would be appended to it and lost along with it.
+                    data = data[:data.rfind(b'\n') + 1]
+                    file.truncate(len(data))
+            for line in data.decode('utf-8').splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[entry['source']] = entry
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def completed(self, source, hash = None):
+        ''' Returns the journal entry if the source already succeeded with the same content, otherwise None. '''
+        entry = self.entries.get(source)
+        if entry and entry['status'] == 'ok' and entry.get('hash') == hash:
+            return entry
+        return None
+
+    def record(self, source, hash = None, status = 'ok', rows = None, error = None):
+        entry = {
+            'source': source,
+            'hash': hash,
+            'status': status,
+            'rows': rows or [],
+            'error': error,
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        self.file.write(json.dumps(entry) + '\n')
+        # Make sure the entry survives the process dying right after this document.
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entries[source] = entry
+        return entry
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,176 @@
+'''
+memprofile.py
+
+Measures memory stage by stage while loading documents and producing output, with tracemalloc (memory
+allocated by Python, attributed exactly) and the process RSS (what the operating system sees, including
+memory tracemalloc can't see), sampled on a background thread to catch peaks between checkpoints.
+
+Stages for each document:
+- raw html: the decoded document text
+- parse tree: the BeautifulSoup tree
+- ix_elements: the element wrappers, with the continuation, unit and tuple indexes
+- contexts: the context index
+- indexes: facts_by_name and series_by_name
+- dataframe: the document's fact table (facts.py)
+- excel writer: the fact table written to an in-memory Excel file
+- released: after closing the document and dropping the DataFrame
+
+For each stage, in MB:
+- peak: the highest traced memory during the stage, above what was allocated before the document
+- retained: the traced memory at the end of the stage, above what was allocated before the document
+- rss: the process RSS at the end of the stage
+- rss peak: the highest RSS sampled during the stage
+
+There's also a batch row per run: its peak is the highest of all the stages, its retained is what's still
+allocated after every document was released (which should be close to nothing, apart from one-off
+allocations such as modules imported on first use), and rss is the growth of the RSS over the run.
+
+tracemalloc slows parsing down severalfold, so this is for benchmarks (see benchmarks.py), not normal runs.
+RSS uses psutil if installed, otherwise /proc (Linux), and is left empty where neither is available.
+'''
+
+import gc
+import io
+import os
+import threading
+import tracemalloc
+
+import pandas as pd
+from pandas import DataFrame
+
+from facts import fact_table
+from ixbrl import XbrliDocument, package_members
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+MB = 1024 * 1024
+
+columns = ['document', 'stage', 'peak', 'retained', 'rss', 'rss peak']
+
+
+def rss():
+    ''' Returns the resident set size of this process in bytes, or None if it can't be found. '''
+    if psutil:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class MemoryProfile:
+    def __init__(self, interval=0.005):
+        ''' interval is how often (in seconds) the RSS is sampled. '''
+        self.interval = interval
+        self.records = []
+        self.document = None
+        self.baseline = 0
+        self.rss_peak = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        gc.collect()
+        tracemalloc.start()
+        self.start_traced = tracemalloc.get_traced_memory()[0]
+        self.start_rss = rss()
+        self.batch_peak = 0
+        self.batch_rss_peak = self.start_rss
+        self.rss_peak = self.start_rss
+        if self.start_rss is not None:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            current = rss()
+            if current > self.rss_peak:
+                self.rss_peak = current
+
+    def begin(self, document):
+        ''' Starts measuring a document, relative to the memory allocated now. '''
+        self.document = document
+        self.baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        self.rss_peak = rss()
+
+    def checkpoint(self, stage):
+        ''' Records the stage that just finished and starts measuring the next one. '''
+        current, peak = tracemalloc.get_traced_memory()
+        current_rss = rss()
+        rss_peak = max(self.rss_peak, current_rss) if current_rss is not None else None
+        self.records.append((self.document, stage, (peak - self.baseline) / MB, (current - self.baseline) / MB,
+                             current_rss / MB if current_rss is not None else None,
+                             rss_peak / MB if rss_peak is not None else None))
+        self.batch_peak = max(self.batch_peak, peak - self.start_traced)
+        if rss_peak is not None:
+            self.batch_rss_peak = max(self.batch_rss_peak, rss_peak)
+        tracemalloc.reset_peak()
+        self.rss_peak = current_rss
+
+    def stop(self):
+        ''' Records the batch row and stops tracing. '''
+        gc.collect()
+        current = tracemalloc.get_traced_memory()[0]
+        end_rss = rss()
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        tracemalloc.stop()
+        self.records.append(('', 'batch', self.batch_peak / MB, (current - self.start_traced) / MB,
+                             (end_rss - self.start_rss) / MB if end_rss is not None else None,
+                             self.batch_rss_peak / MB if self.batch_rss_peak is not None else None))
+
+    @property
+    def dataframe(self):
+        return DataFrame.from_records(self.records, columns=columns)
+
+
+def profile_documents(paths):
+    ''' Loads each document (and each document in a zip) with a MemoryProfile, returning the profile's DataFrame. '''
+    profile = MemoryProfile()
+    profile.start()
+    try:
+        for path in paths:
+            for member in package_members(path=path):
+                profile.begin(f'{path}!{member}' if member else str(path))
+                doc = XbrliDocument(path=path, member=member, checkpoint=profile.checkpoint)
+
+                df = fact_table([doc])
+                profile.checkpoint('dataframe')
+
+                with pd.ExcelWriter(io.BytesIO(), engine='xlsxwriter') as writer:
+                    df.to_excel(writer, index=False)
+                profile.checkpoint('excel writer')
+
+                doc.close()
+                del doc, df
+                gc.collect()
+                profile.checkpoint('released')
+    finally:
+        profile.stop()
+    return profile.dataframe
+
+
+def load_budgets(path='budgets.csv'):
+    ''' Returns the budgets as (stage, measure, limit in MB) tuples. '''
+    df = pd.read_csv(path)
+    return [(stage, measure, float(limit)) for stage, measure, limit in df.itertuples(index=False)]
+
+
+def over_budget(results, budgets):
+    ''' Returns a message for each budget exceeded by any document (or the batch). '''
+    messages = []
+    for stage, measure, limit in budgets:
+        if measure not in columns[2:]:
+            raise ValueError(f'Unknown measure in budget for {stage}: {measure}')
+        rows = results[(results['stage'] == stage) & (results[measure] > limit)]
+        for document, value in zip(rows['document'], rows[measure]):
+            messages.append(f'{document or "batch"}: {stage} {measure} {value:.1f} MB is over the budget of {limit:g} MB')
+    return messages
@@ -0,0 +1,127 @@
+'''
+metrics.py
+
+Derived metrics: named expressions over the output fields of config.csv, defined in metrics.csv:
+
+    Metric Name,Expression
+    General Fund Balance Ratio,[Total General Fund Balance] / [General Fund Expenditures]
+
+Output field names go in square brackets. Expressions can use numbers, + - * / and parentheses, which
+mean the same thing in Python and in Excel, so the same expression is evaluated with pandas and written as
+an Excel formula.
+
+A metric is compiled once and evaluated on whole columns at a time (evaluate), so all the rows of a
+summary are computed together. A field that is missing or not a number gives an empty value, and so does
+a division by zero, rather than an error or an infinity. A metric using a field that isn't in config.csv at
+all is skipped with a warning.
+
+For Excel, excel_formula builds the formula for a row from the columns the fields actually ended up in,
+so the formulas follow config.csv when its columns move.
+'''
+
+import ast
+import re
+
+import numpy as np
+import pandas as pd
+
+
+field_regex = re.compile(r'\[([^\[\]]+)\]')
+
+# The only syntax allowed in an expression once the fields are replaced by names.
+allowed_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub, ast.Mult, ast.Div,
+                 ast.UAdd, ast.USub, ast.Constant, ast.Name, ast.Load)
+
+
+class Metric:
+    def __init__(self, name, expression):
+        self.name = name
+        self.expression = expression
+
+        # Each distinct field becomes a name (_0, _1, ...) for the compiled expression.
+        self.fields = []
+        def replace(match):
+            field = match.group(1).strip()
+            if field not in self.fields:
+                self.fields.append(field)
+            return f'_{self.fields.index(field)}'
+        source = field_regex.sub(replace, expression)
+
+        try:
+            tree = ast.parse(source, mode='eval')
+        except SyntaxError:
+            raise ValueError(f'Invalid expression for {name}: {expression}')
+        for node in ast.walk(tree):
+            if not isinstance(node, allowed_nodes):
+                raise ValueError(f'Invalid expression for {name}: {expression}')
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError(f'Invalid expression for {name}: {expression}')
+            if isinstance(node, ast.Name) and not re.fullmatch(r'_\d+', node.id):
+                raise ValueError(f'Unknown name {node.id} in {name} (fields go in square brackets): {expression}')
+        self.code = compile(tree, f'<metric {name}>', 'eval')
+
+    def __repr__(self):
+        return f'Metric({self.name!r}, {self.expression!r})'
+
+    def evaluate(self, columns):
+        ''' Returns the metric for every row, given a mapping from field name to a column of numbers (a Series). '''
+        names = {f'_{index}': columns[field] for index, field in enumerate(self.fields)}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = eval(self.code, {'__builtins__': {}}, names)
+        if not isinstance(result, pd.Series):
+            # An expression without fields is a constant.
+            result = pd.Series(result, index=next(iter(columns.values())).index if columns else None, dtype=float)
+        return result.replace([np.inf, -np.inf], np.nan)
+
+    def excel_formula(self, columns, row):
+        ''' Returns the Excel formula for a row (0-based, as in XlsxWriter), given the column index of each field. '''
+        from xlsxwriter.utility import xl_rowcol_to_cell
+        return '=' + field_regex.sub(lambda match: xl_rowcol_to_cell(row, columns[match.group(1).strip()]), self.expression)
+
+
+def load_metrics(path='metrics.csv'):
+    ''' Returns the metrics in a metrics CSV file, or none if there's no file. '''
+    try:
+        df = pd.read_csv(path)
+    except FileNotFoundError:
+        return []
+    return [Metric(name, expression) for name, expression in df.itertuples(index=False)]
+
+
+def numeric_column(values):
+    ''' Converts a column of output values (strings, possibly with commas) to numbers, NaN when not a number. '''
+    values = pd.Series(values)
+    if not pd.api.types.is_numeric_dtype(values):
+        values = values.astype(str).str.replace(',', '', regex=False)
+    return pd.to_numeric(values, errors='coerce')
+
+
+def usable_metrics(metrics, fields):
+    '''
+    Returns the metrics whose fields are all output fields. The others are left out with a warning, so a
+    config.csv without some of the fields still gets its outputs, just without those metrics.
+    '''
+    usable = []
+    for metric in metrics:
+        missing = [field for field in metric.fields if field not in fields]
+        if missing:
+            print(f'*** Warning: Skipping metric {metric.name}: unknown output fields {", ".join(missing)}')
+        else:
+            usable.append(metric)
+    return usable
+
+
+def add_metrics(df, metrics):
+    '''
+    Returns the summary DataFrame with a column added for each metric, computed for all rows at once.
+    Metrics using fields that aren't in the DataFrame are skipped (see usable_metrics).
+    '''
+    metrics = usable_metrics(metrics, df.columns)
+    columns = {}
+    df = df.copy()
+    for metric in metrics:
+        for field in metric.fields:
+            if field not in columns:
+                columns[field] = numeric_column(df[field]).set_axis(df.index)
+        df[metric.name] = metric.evaluate(columns)
+    return df
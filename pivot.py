@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+'''
+pivot.py
+
+Exports facts with their dimensions, however many axes a context has (dumpix.py only has room for two).
+
+Two layouts:
+- long: one row per fact and axis, with axis and member columns. A fact without dimensions has one row with
+  an empty axis and member.
+- wide: one row per fact, with a column per axis (named after the axis) holding the member, empty when the
+  fact's context doesn't use that axis.
+
+The fact columns are those of the fact table (see facts.py) apart from dimensions, which the axis columns
+replace. document_index tells the documents apart, since two can have the same source. Typed members are
+included like explicit ones, with their value as the member.
+
+The dimensions are looked up once per context and joined to the facts, rather than once per fact, and the
+repetitive columns (concept, axis, member and the like) are pandas categoricals: each distinct value is stored
+once and the rows hold small integer codes, which is most of the memory of a fact table.
+
+    python pivot.py test_data/*.xhtml --layout wide --out pivot.csv
+    python pivot.py filings.zip --layout long --out pivot.parquet
+'''
+
+import argparse
+
+import pandas as pd
+from pandas import DataFrame
+
+from facts import fact_rows, columns as fact_columns
+from getix import load_documents, release
+
+
+member_columns = ['document_index', 'contextref', 'axis', 'member']
+
+# A document is identified by its position in the list (its source can be empty, or repeated).
+document_keys = ['document_index', 'contextref']
+
+# Columns with few distinct values compared to their number of rows.
+categorical_columns = ['document', 'concept', 'contextref', 'period_type', 'unit', 'decimals', 'scale', 'tupleref', 'axis',
+                       'member']
+
+
+def member_rows(doc, index):
+    ''' Yields (document_index, contextref, axis, member) for each explicit and typed member of each context. '''
+    for context_id, context in doc.contexts.items():
+        for axis, member in context.dimensions.items():
+            yield index, context_id, axis, member
+        for axis, value in context.typed_members.items():
+            yield index, context_id, axis, value
+
+
+def categorize(df):
+    ''' Converts the categorical columns that are in the DataFrame, in place. '''
+    for column in categorical_columns:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+
+def tables(docs):
+    ''' Returns (facts, members) DataFrames for the documents, reading each document once. '''
+    facts = []
+    members = []
+    for index, doc in enumerate(docs):
+        facts.extend((index,) + row for row in fact_rows(doc))
+        members.extend(member_rows(doc, index))
+    facts = DataFrame.from_records(facts, columns=['document_index'] + fact_columns).drop(columns='dimensions')
+    facts['value'] = pd.to_numeric(facts['value'], errors='coerce')
+    members = DataFrame.from_records(members, columns=member_columns)
+    return categorize(facts), categorize(members)
+
+
+def aligned(facts, members):
+    ''' Returns copies of facts and members with the same categories for the document keys, which merging on categoricals needs. '''
+    facts, members = facts.copy(), members.copy()
+    for key in document_keys:
+        if not isinstance(facts[key].dtype, pd.CategoricalDtype):
+            continue
+        categories = facts[key].cat.categories.union(members[key].cat.categories)
+        facts[key] = facts[key].cat.set_categories(categories)
+        members[key] = members[key].cat.set_categories(categories)
+    return facts, members
+
+
+def long_table(facts, members):
+    ''' One row per fact and axis (one row with no axis for facts without dimensions). '''
+    facts, members = aligned(facts, members)
+    facts['fact'] = range(len(facts))
+    df = facts.merge(members, on=document_keys, how='left', sort=False)
+    df = df.sort_values(['fact', 'axis'], kind='stable').drop(columns='fact').reset_index(drop=True)
+    return df
+
+
+def wide_table(facts, members):
+    ''' One row per fact with a column per axis. '''
+    if members.empty:
+        return facts.copy()
+    facts, members = aligned(facts, members)
+    # The axis columns are in name order, each with only the members used on that axis as its categories.
+    axes = members.astype({'member': str}).pivot(index=document_keys, columns='axis', values='member')
+    axes = axes[sorted(axes.columns)].astype('category')
+    axes.columns = list(axes.columns)
+    return facts.merge(axes.reset_index(), on=document_keys, how='left', sort=False)
+
+
+def pivot(docs, layout='wide'):
+    ''' Returns the pivot export for the documents in the given layout (long or wide). '''
+    facts, members = tables(docs)
+    if layout == 'long':
+        return long_table(facts, members)
+    if layout == 'wide':
+        return wide_table(facts, members)
+    raise ValueError(f'Unknown layout: {layout}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports facts with a column per dimension axis (wide) or a row per axis (long).')
+    parser.add_argument('paths', nargs='+', help='iXBRL files (can be compressed or zipped)')
+    parser.add_argument('--layout', choices=['long', 'wide'], default='wide')
+    parser.add_argument('--out', default='pivot.csv', help='output file (.csv or .parquet)')
+    args = parser.parse_args()
+
+    def documents():
+        # The facts are taken as each document is loaded, then its tree is freed.
+        for doc in load_documents(args.paths):
+            yield doc
+            release(doc)
+
+    df = pivot(documents(), args.layout)
+    if args.out.endswith('.parquet'):
+        df.to_parquet(args.out, index=False)
+    else:
+        df.to_csv(args.out, index=False)
+    print(f'Wrote {len(df)} rows to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+'''
+query.py
+
+A small query language for selecting facts, a superset of the config.csv input field syntax:
+
+    us-cafr:FundBalances (us-cafr:GeneralFundMember us-cafr:CommittedMember)
+
+Terms:
+- The concept comes first, and can use * and ? wildcards: us-cafr:Revenue*
+- Inside the parentheses, space separated:
+    member              the context must have this explicit member
+    !member             the context must not have this explicit member
+    axis=member         the axis must have exactly this member
+    axis=*              the axis must be present
+    !axis=*             the axis must not be present
+- After the parentheses, optional period terms:
+    @instant, @duration   the period type
+    @2017-12-31           the period ends on this date
+    @2017-01-01..2017-12-31, @2017-01-01.., @..2017-12-31   the period ends in this range (inclusive)
+
+A query is compiled once into a Query plan. compile_query caches the plans by text, so running the same
+queries over many documents only pays for parsing once. A plan runs on the document's facts_by_name and
+series_by_name indexes rather than scanning every element, and concept wildcards are matched once per distinct name.
+
+Selecting a single value uses the document's FactSeries, which are already in period order with duplicates
+resolved, so the latest period (select), a fiscal year (select with year) or all periods (select_all) never
+sort the matched facts.
+'''
+
+import datetime
+import fnmatch
+import heapq
+import re
+from functools import lru_cache
+
+from ixbrl import NO_PERIOD
+
+
+query_regex = re.compile(r'\s*(?P<concept>[^\s(@]+)\s*(?:\((?P<members>[^)]*)\))?\s*(?P<periods>.*?)\s*$')
+period_types = ('instant', 'duration', 'forever')
+
+
+class Query:
+    ''' A compiled query. Use compile_query(text) rather than creating these directly, so plans are shared. '''
+    def __init__(self, text):
+        self.text = text
+        result = query_regex.match(text)
+        if not result or not result.group('concept'):
+            raise ValueError(f'Invalid query: {text!r}')
+
+        self.concept = result.group('concept')
+        if any(character in self.concept for character in '*?['):
+            self.concept_regex = re.compile(fnmatch.translate(self.concept))
+        else:
+            self.concept_regex = None
+        self._name_matches = {}   # concept name: bool, for wildcard concepts
+
+        required, excluded, dimensions, excluded_axes = set(), set(), {}, set()
+        for term in (result.group('members') or '').split():
+            negated = term.startswith('!')
+            term = term.lstrip('!')
+            if '=' in term:
+                axis, member = term.split('=', 1)
+                if negated:
+                    if member != '*':
+                        raise ValueError(f'Only !axis=* can be negated in query: {text!r}')
+                    excluded_axes.add(axis)
+                else:
+                    dimensions[axis] = member
+            elif negated:
+                excluded.add(term)
+            else:
+                required.add(term)
+        self.required_members = frozenset(required)
+        self.excluded_members = frozenset(excluded)
+        self.dimensions = dimensions
+        self.excluded_axes = frozenset(excluded_axes)
+
+        self.period_type = None
+        self.period_from = self.period_to = None
+        for term in result.group('periods').split():
+            if not term.startswith('@'):
+                raise ValueError(f'Period terms start with @ in query: {text!r}')
+            term = term[1:]
+            if term in period_types:
+                self.period_type = term
+            elif '..' in term:
+                start, end = term.split('..', 1)
+                self.period_from = parse_date(start, text) if start else None
+                self.period_to = parse_date(end, text) if end else None
+            else:
+                self.period_from = self.period_to = parse_date(term, text)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f'Query({self.text!r})'
+
+    def matches_name(self, name):
+        if self.concept_regex is None:
+            return name == self.concept
+        try:
+            return self._name_matches[name]
+        except KeyError:
+            matches = self._name_matches[name] = bool(self.concept_regex.match(name))
+            return matches
+
+    @property
+    def has_period_terms(self):
+        return bool(self.period_type or self.period_from or self.period_to)
+
+    def matches_members(self, members, dimensions):
+        ''' Returns True if the explicit members (and axis: member dictionary) satisfy the member and axis terms. '''
+        if not self.required_members.issubset(members) or not self.excluded_members.isdisjoint(members):
+            return False
+        for axis, member in self.dimensions.items():
+            if axis not in dimensions or (member != '*' and dimensions[axis] != member):
+                return False
+        return self.excluded_axes.isdisjoint(dimensions)
+
+    def matches_period(self, context):
+        ''' Returns True if the context satisfies the period terms. '''
+        if self.period_type and context.period_type != self.period_type:
+            return False
+        if self.period_from or self.period_to:
+            end = context.period_end
+            if end is None:
+                return False
+            if self.period_from and end < self.period_from:
+                return False
+            if self.period_to and end > self.period_to:
+                return False
+        return True
+
+    def matches_context(self, context, contextref = None):
+        ''' 
+        Returns True if the context satisfies the member, axis and period terms.
+        Without a formal context definition, only the contextref itself can be matched against members.
+        '''
+        if context is None:
+            return self.matches_members({contextref}, {}) and not self.has_period_terms
+        return self.matches_members(context.explicit_members, context.dimensions) and self.matches_period(context)
+
+    def matches_element(self, element):
+        ''' Same interface as Criterion, for code that still walks the elements itself. '''
+        try:
+            if not self.matches_name(element.name):
+                return False
+        except KeyError:
+            return False
+        contextref = element.tag.get('contextref')
+        return self.matches_context(element.doc.contexts.get(contextref), contextref)
+
+    def find(self, doc):
+        ''' Returns the matching facts in the document, in document order within each concept. '''
+        if self.concept_regex is None:
+            names = [self.concept]
+        else:
+            names = [name for name in doc.facts_by_name if self.matches_name(name)]
+
+        contexts = doc.contexts
+        found = []
+        for name in names:
+            for element in doc.facts_by_name.get(name, []):
+                contextref = element.tag.get('contextref')
+                if self.matches_context(contexts.get(contextref), contextref):
+                    found.append(element)
+        return found
+
+    def series(self, doc):
+        ''' Returns the document's FactSeries that match the concept, member and axis terms. '''
+        if self.concept_regex is None:
+            candidates = doc.series_by_name.get(self.concept, [])
+        else:
+            candidates = [series for name, series_list in doc.series_by_name.items() if self.matches_name(name)
+                          for series in series_list]
+        return [series for series in candidates if self.matches_members(series.members, series.dimensions)]
+
+    def _series_facts(self, series, year = None, latest = True):
+        '''
+        The facts in the series that satisfy the period terms (and year), only the latest one with latest.
+        The period terms are applied to every period in the year, before taking the latest, so a year with
+        an instant and a duration ending the same day still finds whichever one the terms ask for.
+        '''
+        start, end = self.period_from, self.period_to
+        if year is not None:
+            year_start, year_end = datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+            start = max(start, year_start) if start else year_start
+            end = min(end, year_end) if end else year_end
+        facts = series.between(start, end) if start or end else series.facts
+
+        if self.has_period_terms:
+            facts = [fact for fact in facts if fact.doc.contexts.get(fact.tag.get('contextref')) is not None
+                     and self.matches_period(fact.context)]
+        if latest:
+            return facts[-1:]
+        return facts
+
+    def select(self, doc, year = None):
+        ''' 
+        Returns the matching fact with the most recent period (or the latest in the given fiscal year), or None.
+        Equal periods go to the fact later in the document.
+        '''
+        best = None
+        for series in self.series(doc):
+            for fact in self._series_facts(series, year):
+                if best is None or sort_key(fact) > sort_key(best):
+                    best = fact
+        return best
+
+    def select_all(self, doc):
+        ''' Returns every matching fact (one per period and dimension set), in period order.
+            Each series is already in period order, so they are merged rather than sorted. '''
+        return list(heapq.merge(*[self._series_facts(series, latest=False) for series in self.series(doc)], key = sort_key))
+
+
+def sort_key(fact):
+    context = fact.doc.contexts.get(fact.tag.get('contextref'))
+    period_key = context.period_key if context is not None else NO_PERIOD
+    return (period_key, fact.position)
+
+
+def select_latest(queries, doc, year = None):
+    ''' Returns the most recent fact matched by any of the queries, or None. '''
+    best = None
+    for query in queries:
+        fact = query.select(doc, year)
+        if fact is not None and (best is None or sort_key(fact) > sort_key(best)):
+            best = fact
+    return best
+
+
+def parse_date(text, query):
+    try:
+        return datetime.date.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f'Invalid date {text!r} in query: {query!r}')
+
+
+@lru_cache(maxsize=1024)
+def compile_query(text):
+    ''' Returns the Query plan for the text, compiling it only the first time it is seen. '''
+    return Query(text)
+
+
+# A filing where a period has both an instant and a duration fact for the same concept.
+test_document = b"""<html xmlns="http://www.w3.org/1999/xhtml" xmlns:ix="http://www.xbrl.org/2013/inlineXBRL" xmlns:xbrli="http://www.xbrl.org/2003/instance"><body>
+<ix:header><ix:resources>
+<xbrli:context id="i2017"><xbrli:entity><xbrli:identifier scheme="x">1</xbrli:identifier></xbrli:entity><xbrli:period><xbrli:instant>2017-12-31</xbrli:instant></xbrli:period></xbrli:context>
+<xbrli:context id="d2017"><xbrli:entity><xbrli:identifier scheme="x">1</xbrli:identifier></xbrli:entity><xbrli:period><xbrli:startDate>2017-01-01</xbrli:startDate><xbrli:endDate>2017-12-31</xbrli:endDate></xbrli:period></xbrli:context>
+<xbrli:context id="i2018"><xbrli:entity><xbrli:identifier scheme="x">1</xbrli:identifier></xbrli:entity><xbrli:period><xbrli:instant>2018-12-31</xbrli:instant></xbrli:period></xbrli:context>
+<xbrli:unit id="USD"><xbrli:measure>iso4217:USD</xbrli:measure></xbrli:unit>
+</ix:resources></ix:header>
+<ix:nonFraction name="us-cafr:B" contextRef="i2017" unitRef="USD" decimals="0">1</ix:nonFraction>
+<ix:nonFraction name="us-cafr:B" contextRef="d2017" unitRef="USD" decimals="0">2</ix:nonFraction>
+<ix:nonFraction name="us-cafr:B" contextRef="i2018" unitRef="USD" decimals="0">3</ix:nonFraction>
+</body></html>"""
+
+
+def test():
+    ''' Checks selecting by fiscal year together with period terms. '''
+    import io
+    from ixbrl import XbrliDocument
+
+    doc = XbrliDocument(file=io.BytesIO(test_document))
+    expected = [('us-cafr:B', 2017, '2'), ('us-cafr:B @instant', 2017, '1'), ('us-cafr:B @duration', 2017, '2'),
+                ('us-cafr:B @instant', 2018, '3'), ('us-cafr:B @duration', 2018, None),
+                ('us-cafr:B @2017-01-01..2017-06-30', 2017, None), ('us-cafr:B @instant', None, '3')]
+    for text, year, value in expected:
+        fact = compile_query(text).select(doc, year)
+        result = fact.string if fact is not None else None
+        assert result == value, f'{text} in {year}: expected {value}, got {result}'
+    print(f'{len(expected)} queries checked')
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+'''
+server.py
+
+A local server that keeps parsed documents in memory, so refreshing the same filings (from the Excel
+workbook or a notebook) doesn't parse them again every time.
+
+    python server.py                      # http://127.0.0.1:8765
+    python server.py --port 9000 --cache-mb 2000
+    python server.py --socket /tmp/cafr.sock
+
+Documents are kept in a least recently used cache limited by memory. A parsed document takes roughly
+bytes_per_char times its text in memory (see python benchmarks.py memory), which is what is counted against
+the limit. A local file is parsed again if it changed since it was cached.
+
+Requests and responses are JSON. A source is {"path": ...}, {"url": ...}, optionally with "member" for zips.
+
+    POST /select   {"source": ..., "fields": [["query", ...], ...], "year": 2018, "combine": "first"}
+                   -> {"values": ["1,234", "", ...]}
+        A value for each field: the fact selected by the field's queries (see query.py), "" if none.
+        With combine "first" the first query that matches wins (as in config.csv), with "latest" the
+        most recent period matched by any of them (as in the workbook).
+    POST /facts    {"source": ..., "query": "us-cafr:NetPosition*", "all": false}
+                   -> {"facts": [{"name": ..., "contextref": ..., "string": ..., "period_end": ..., "unit": ...}, ...]}
+        The facts the query finds, or with all every period of each dimension set in period order.
+    GET /status    -> {"documents": [...], "size_mb": ..., "limit_mb": ..., "hits": ..., "misses": ...}
+
+Errors are returned as {"error": message}, with status 400 for a bad request and 500 if the document
+couldn't be loaded.
+
+DocumentClient is the client side, used by getix.py (SummarySpreadsheet's server argument) and cafr_excel.py
+(the CAFR_SERVER environment variable).
+'''
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import socketserver
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from ixbrl import XbrliDocument
+from query import compile_query, select_latest
+
+
+DEFAULT_PORT = 8765
+MB = 1024 * 1024
+
+
+class ServerError(Exception):
+    pass
+
+
+class DocumentCache:
+    def __init__(self, limit_mb=1000, bytes_per_char=16):
+        self.limit = limit_mb * MB
+        self.bytes_per_char = bytes_per_char
+        self.entries = OrderedDict()   # source key: (document, estimated size, file stamp), least recent first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.loading = {}   # source key: threading.Event set when its load finishes
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(source):
+        ''' The cache key for a source, with paths made absolute. '''
+        if source.get('path'):
+            location = str(Path(source['path']).resolve())
+        elif source.get('url'):
+            location = source['url']
+        else:
+            raise ValueError('A source needs a path or a url')
+        return (location, source.get('member'))
+
+    @staticmethod
+    def stamp(key):
+        ''' Modification time and size for a local file, so changed files are reloaded. '''
+        location = key[0]
+        if os.path.exists(location):
+            stat = os.stat(location)
+            return (stat.st_mtime_ns, stat.st_size)
+        return None
+
+    def get(self, source):
+        '''
+        Returns the parsed document for the source, loading it if it isn't cached (or its file changed).
+        The lock is only held to look up and insert, so a slow download or parse doesn't hold up other
+        requests. A document being loaded has an event in loading, and requests for it wait on that
+        rather than parsing it a second time.
+        '''
+        key = self.key(source)
+        stamp = self.stamp(key)
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry[2] == stamp:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                loading = self.loading.get(key)
+                if loading is None:
+                    loading = self.loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Another request is loading it. Look again once it's done (if it failed, this one tries).
+            loading.wait()
+
+        try:
+            if source.get('path'):
+                doc = XbrliDocument(path=key[0], member=key[1])
+            else:
+                doc = XbrliDocument(url=key[0], member=key[1])
+        except Exception:
+            with self.lock:
+                del self.loading[key]
+            loading.set()
+            raise
+
+        size = doc.text_size * self.bytes_per_char
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)   # An older version of a file that changed.
+            self.entries[key] = (doc, size, stamp)
+            self.size += size
+
+            # The newest document is kept even if it's over the limit by itself.
+            while self.size > self.limit and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+            del self.loading[key]
+        loading.set()
+        return doc
+
+    def _remove(self, key):
+        # Not closed, a request may still be using it. It's freed once nothing refers to it.
+        doc, size, stamp = self.entries.pop(key)
+        self.size -= size
+
+    def status(self):
+        with self.lock:
+            return {'documents': [location + (f'!{member}' if member else '') for location, member in self.entries],
+                    'size_mb': round(self.size / MB, 1),
+                    'limit_mb': round(self.limit / MB, 1),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+def select_values(doc, fields, year=None, combine='first'):
+    ''' Returns the value of each field (a list of queries) in the document, "" where nothing matches. '''
+    values = []
+    for texts in fields:
+        queries = [compile_query(text) for text in texts]
+        if combine == 'latest':
+            fact = select_latest(queries, doc, year)
+        elif combine == 'first':
+            fact = next((fact for fact in (query.select(doc, year) for query in queries) if fact is not None), None)
+        else:
+            raise ValueError(f'Unknown combine: {combine}')
+        values.append(fact.string if fact is not None else '')
+    return values
+
+
+def fact_json(fact):
+    context = fact.context
+    unit = fact.unit
+    return {'name': fact.name,
+            'contextref': fact.tag.get('contextref'),
+            'string': fact.string,
+            'period_end': str(context.period_end) if context is not None and context.period_end else None,
+            'unit': unit.measure if unit else None}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    ''' Answers the JSON requests, using the server's document cache. '''
+    def do_GET(self):
+        if self.path == '/status':
+            self.respond(200, self.server.cache.status())
+        else:
+            self.respond(404, {'error': f'Unknown path: {self.path}'})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if self.path not in ('/select', '/facts'):
+                self.respond(404, {'error': f'Unknown path: {self.path}'})
+                return
+            source = request.get('source') or {}
+            self.server.cache.key(source)
+        except (ValueError, AttributeError) as e:
+            self.respond(400, {'error': str(e)})
+            return
+
+        try:
+            doc = self.server.cache.get(source)
+        except Exception as e:
+            self.respond(500, {'error': f'Unable to load {source}: {e}'})
+            return
+
+        try:
+            if self.path == '/select':
+                response = {'values': select_values(doc, request.get('fields', []), request.get('year'),
+                                                    request.get('combine', 'first'))}
+            else:
+                query = compile_query(request['query'])
+                facts = query.select_all(doc) if request.get('all') else query.find(doc)
+                response = {'facts': [fact_json(fact) for fact in facts]}
+        except (ValueError, KeyError, TypeError) as e:
+            self.respond(400, {'error': str(e)})
+            return
+        self.respond(200, response)
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address[0] if self.client_address else 'local'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(cache, port=DEFAULT_PORT, socket_path=None):
+    ''' Returns the HTTP server (on localhost only), or a Unix socket server with socket_path. '''
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+    server.cache = cache
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DocumentClient:
+    def __init__(self, address=f'http://127.0.0.1:{DEFAULT_PORT}', timeout=600):
+        ''' address is the server's URL, or the path of its Unix socket. '''
+        self.address = address
+        self.timeout = timeout
+
+    def connection(self):
+        if self.address.startswith('http://'):
+            host = self.address[len('http://'):].rstrip('/')
+            return http.client.HTTPConnection(host, timeout=self.timeout)
+        return UnixHTTPConnection(self.address, timeout=self.timeout)
+
+    def request(self, method, path, body=None):
+        connection = self.connection()
+        try:
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+            headers = {'Content-Type': 'application/json'} if data else {}
+            connection.request(method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise ServerError(result.get('error', f'Status {response.status}'))
+        return result
+
+    def select(self, fields, path=None, url=None, member=None, year=None, combine='first'):
+        ''' Returns the value of each field (a list of query strings) for the document. '''
+        return self.request('POST', '/select', {'source': source(path, url, member), 'fields': fields,
+                                                'year': year, 'combine': combine})['values']
+
+    def facts(self, query, path=None, url=None, member=None, all=False):
+        ''' Returns the facts found by the query, as dictionaries. '''
+        return self.request('POST', '/facts', {'source': source(path, url, member), 'query': query, 'all': all})['facts']
+
+    def status(self):
+        return self.request('GET', '/status')
+
+
+def source(path=None, url=None, member=None):
+    ''' The JSON source for a document. Paths are made absolute, the server may have another working directory. '''
+    if path:
+        result = {'path': str(Path(path).resolve())}
+    else:
+        result = {'url': url}
+    if member:
+        result['member'] = member
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves queries on cached parsed documents.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port on localhost')
+    parser.add_argument('--socket', default=None, help='listen on this Unix socket instead')
+    parser.add_argument('--cache-mb', type=float, default=1000, help='memory for cached documents')
+    args = parser.parse_args()
+
+    server = make_server(DocumentCache(args.cache_mb), args.port, args.socket)
+    print(f'Serving on {args.socket or f"http://127.0.0.1:{args.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
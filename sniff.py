@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+'''
+sniff.py
+
+Quick triage of input files without parsing them: whether each is inline XBRL, its size, roughly how many
+facts and contexts it has, and which of the config.csv concepts it probably contains.
+
+The file is memory mapped and searched for byte patterns (the ix:header, fact and xbrli:context start tags
+and the name attributes), which runs at about the speed the file can be read, far faster than building the
+parse tree. The counts are of start tags, so they're approximate: a fact split by continuations still counts
+once, and tags inside comments count too. A concept counts as present if some name attribute has it.
+
+Gzip and zip files can't be mapped, so their documents are decompressed into memory and searched the same
+way, and their sizes are the decompressed sizes. Each document in a zip (or a gzipped zip) is sniffed
+separately. Documents in UTF-16 aren't recognized.
+
+    python sniff.py test_data/*.xhtml
+    python sniff.py filings/* --config config.csv --out sniff.csv
+
+estimate is the cheaper check batch.py plans with: whether a file is inline XBRL from the first megabyte of
+each document, and its decompressed size from the zip directory or gzip trailer, without decompressing it.
+'''
+
+import argparse
+import gzip
+import io
+import mmap
+import os
+import re
+import time
+import zipfile
+import zlib
+
+import pandas as pd
+from pandas import DataFrame
+
+from ixbrl import GZIP_MAGIC, ZIP_MAGIC, document_members, read_head
+from query import compile_query
+
+
+# What reading a damaged file can raise. estimate leaves those files to be processed, which reports the error.
+read_errors = (OSError, EOFError, zipfile.BadZipFile, zlib.error)
+
+# estimate only looks this far into each document.
+HEAD_BYTES = 1024 * 1024
+
+# The ix:header, or the inline XBRL namespace (declared on the root element, at the very start).
+head_regex = re.compile(rb'<ix:header[\s/>]|http://www\.xbrl\.org/2013/inlineXBRL', re.IGNORECASE)
+
+tag_regex = re.compile(rb'<(ix:header|ix:nonfraction|ix:nonnumeric|ix:fraction|xbrli:context)[\s/>]', re.IGNORECASE)
+name_regex = re.compile(rb'\sname\s*=\s*["\']([\w.-]+:[\w.-]+)["\']', re.IGNORECASE)
+
+fact_tags = (b'ix:nonfraction', b'ix:nonnumeric', b'ix:fraction')
+
+columns = ['path', 'member', 'size', 'ixbrl', 'facts', 'contexts', 'concepts', 'seconds']
+
+
+def config_concepts(config_path='config.csv'):
+    ''' Returns the distinct concepts (or concept patterns) used by the config file's input fields. '''
+    df = pd.read_csv(config_path)
+    concepts = []
+    for input_name in df.iloc[:, 1]:
+        concept = compile_query(input_name).concept
+        if concept not in concepts:
+            concepts.append(concept)
+    return concepts
+
+
+def scan(data, concepts=()):
+    ''' Returns (is inline XBRL, facts, contexts, concepts found) for a document's bytes (or an mmap). '''
+    counts = {}
+    for match in tag_regex.finditer(data):
+        tag = match.group(1).lower()
+        counts[tag] = counts.get(tag, 0) + 1
+    names = {match.group(1).decode('ascii', 'replace') for match in name_regex.finditer(data)}
+
+    found = []
+    for concept in concepts:
+        query = compile_query(concept)
+        if concept in names or (query.concept_regex and any(query.matches_name(name) for name in names)):
+            found.append(concept)
+    return (counts.get(b'ix:header', 0) > 0, sum(counts.get(tag, 0) for tag in fact_tags),
+            counts.get(b'xbrli:context', 0), found)
+
+
+def sniff_zip(path, file, size, concepts=()):
+    ''' Returns the result rows for each document in a zip (a path or a file object). '''
+    results = []
+    start = time.perf_counter()
+    with zipfile.ZipFile(file) as zip_file:
+        members = document_members(zip_file)
+        for member in members:
+            start = time.perf_counter()
+            data = zip_file.read(member)
+            if data.startswith(GZIP_MAGIC):
+                data = gzip.decompress(data)
+            results.append([path, member, len(data), *scan(data, concepts), time.perf_counter() - start])
+    if not members:
+        results.append([path, None, size, False, 0, 0, [], time.perf_counter() - start])
+    return results
+
+
+def sniff(path, concepts=()):
+    ''' Returns a list of result rows (in the order of columns), one per document in the file. '''
+    path = str(path)
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        head = file.read(len(ZIP_MAGIC))
+        file.seek(0)
+        start = time.perf_counter()
+
+        if head.startswith(ZIP_MAGIC):
+            return sniff_zip(path, file, size, concepts)
+        if head.startswith(GZIP_MAGIC):
+            with gzip.GzipFile(fileobj=file) as gzip_file:
+                data = gzip_file.read()
+            if data.startswith(ZIP_MAGIC):
+                # A compressed report package.
+                return sniff_zip(path, io.BytesIO(data), len(data), concepts)
+            return [[path, None, len(data), *scan(data, concepts), time.perf_counter() - start]]
+        if size == 0:
+            return [[path, None, 0, False, 0, 0, [], 0.0]]
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return [[path, None, size, *scan(data, concepts), time.perf_counter() - start]]
+
+
+def head_is_ixbrl(stream):
+    ''' True if the first HEAD_BYTES of a document (a binary stream, undoing gzip) look like inline XBRL. '''
+    stream, head = read_head(stream)
+    head += stream.read(HEAD_BYTES - len(head))
+    return head_regex.search(head) is not None
+
+
+def gzip_size(file):
+    ''' The uncompressed size from a gzip file's ISIZE trailer (modulo 4 GB, as the format stores it). '''
+    file.seek(-4, os.SEEK_END)
+    size = int.from_bytes(file.read(4), 'little')
+    file.seek(0)
+    return size
+
+
+def estimate(path):
+    '''
+    Returns (size, is inline XBRL) for a file, reading only a little of it: the decompressed size of its inline
+    XBRL documents, and whether it has any. batch.py plans the shards with this on every node, so it mustn't
+    decompress whole files the way sniff does.
+
+    Sizes come from the zip central directory and the gzip ISIZE trailer, and whether a document is inline XBRL
+    from its first HEAD_BYTES. A zip inside gzip can't be looked into without decompressing all of it, so it
+    counts as inline XBRL, with the gzip's size, and a gzipped document inside a zip counts with its
+    compressed size. A document that can't be read counts as inline XBRL, so processing it reports the error.
+    '''
+    path = str(path)
+    with open(path, 'rb') as file:
+        head = file.read(len(ZIP_MAGIC))
+        file.seek(0)
+        if head.startswith(ZIP_MAGIC):
+            with zipfile.ZipFile(file) as zip_file:
+                size, ixbrl = 0, False
+                for member in document_members(zip_file):
+                    try:
+                        with zip_file.open(member) as stream:
+                            member_ixbrl = head_is_ixbrl(stream)
+                    except read_errors:
+                        member_ixbrl = True
+                    if member_ixbrl:
+                        size += zip_file.getinfo(member).file_size
+                        ixbrl = True
+                return size, ixbrl
+        if head.startswith(GZIP_MAGIC):
+            size = gzip_size(file)
+            with gzip.GzipFile(fileobj=file) as gzip_file:
+                head = gzip_file.read(HEAD_BYTES)
+            if head.startswith(ZIP_MAGIC):
+                return size, True
+            ixbrl = head_regex.search(head) is not None
+            return (size if ixbrl else 0), ixbrl
+        ixbrl = head_is_ixbrl(file)
+        return (os.path.getsize(path) if ixbrl else 0), ixbrl
+
+
+def sniff_files(paths, concepts=()):
+    ''' Returns a DataFrame of the sniff results for the files, a row per document. '''
+    rows = []
+    for path in paths:
+        rows.extend(sniff(path, concepts))
+    return DataFrame(rows, columns=columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sniffs input files for inline XBRL without parsing them.')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--config', default='config.csv', help='report which of its concepts each file has')
+    parser.add_argument('--out', default=None, help='also write the results to this CSV file')
+    args = parser.parse_args()
+
+    concepts = config_concepts(args.config) if os.path.exists(args.config) else []
+    df = sniff_files(args.paths, concepts)
+    df['seconds'] = df['seconds'].round(4)
+    if args.out:
+        df.assign(concepts=[' '.join(found) for found in df['concepts']]).to_csv(args.out, index=False)
+    # Just how many of the concepts were found, the list is in the CSV.
+    print(df.assign(concepts=[f'{len(found)}/{len(concepts)}' for found in df['concepts']]).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()